@@ -5,29 +5,33 @@ import os
 from flask import request
 from flask import Flask
 
-import requests
-
+from common import http_client
 from common.factory import create_billing
-from common.utils import log_error, log_info
+from common.utils import list_entities, log_error, log_info
+from lib.codec import decode_entity
 from lib.event_store import Event, EventStore
 
 
 app = Flask(__name__)
 store = EventStore()
 
+GROUP = 'billing-service'
+WORKERS = 4
+
 
 def order_created(item):
     try:
-        msg_data = json.loads(item[1][0][1]['entity'])
+        msg_data = decode_entity(item[1][0][1])
         customer = store.find_one('customer', msg_data['customer_id'])
-        products = [store.find_one('product', product_id) for product_id in msg_data['product_ids']]
+        products = store.find_many('product', msg_data['product_ids'])
+        products = [products[product_id] for product_id in msg_data['product_ids']]
         msg = """Dear {}!
 
 Please transfer € {} with your favourite payment method.
 
 Cheers""".format(customer['name'], sum([int(product['price']) for product in products]))
 
-        requests.post('http://msg-service:5000/email', json={
+        http_client.post('http://msg-service:5000/email', json={
             "to": customer['email'],
             "msg": msg
         })
@@ -37,17 +41,18 @@ Cheers""".format(customer['name'], sum([int(product['price']) for product in pro
 
 def billing_created(item):
     try:
-        msg_data = json.loads(item[1][0][1]['entity'])
+        msg_data = decode_entity(item[1][0][1])
         order = store.find_one('order', msg_data['order_id'])
         customer = store.find_one('customer', order['customer_id'])
-        products = [store.find_one('product', product_id) for product_id in order['product_ids']]
+        products = store.find_many('product', order['product_ids'])
+        products = [products[product_id] for product_id in order['product_ids']]
         msg = """Dear {}!
 
 We've just received € {} from you, thank you for your transfer.
 
 Cheers""".format(customer['name'], sum([int(product['price']) for product in products]))
 
-        requests.post('http://msg-service:5000/email', json={
+        http_client.post('http://msg-service:5000/email', json={
             "to": customer['email'],
             "msg": msg
         })
@@ -56,20 +61,25 @@ Cheers""".format(customer['name'], sum([int(product['price']) for product in pro
 
 
 def subscribe_to_domain_events():
-    store.subscribe('order', 'created', order_created)
-    store.subscribe('billing', 'created', billing_created)
+    store.subscribe('order', 'created', order_created, _group=GROUP, _workers=WORKERS)
+    store.subscribe('billing', 'created', billing_created, _group=GROUP, _workers=WORKERS)
     log_info('subscribed to domain events')
 
 
 def unsubscribe_from_domain_events():
-    store.unsubscribe('order', 'created', order_created)
-    store.unsubscribe('billing', 'created', billing_created)
+    store.unsubscribe('order', 'created', order_created, _group=GROUP)
+    store.unsubscribe('billing', 'created', billing_created, _group=GROUP)
     log_info('unsubscribed from domain events')
 
 
 if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     store.subscribe_to_entity_events('billing')
     atexit.register(store.unsubscribe_from_entity_events, 'billing')
+    store.enable_snapshots('billing')
+    store.enable_retention('billing')
+    for topic in ('customer', 'product'):
+        store.enable_cache(topic)
+        atexit.register(store.disable_cache, topic)
     subscribe_to_domain_events()
     atexit.register(unsubscribe_from_domain_events)
 
@@ -85,7 +95,7 @@ def get(billing_id=None):
 
         return json.dumps(billing) if billing else json.dumps(False)
     else:
-        return json.dumps([item for item in store.find_all('billing').values()])
+        return list_entities(store, 'billing', request.args)
 
 
 @app.route('/billing', methods=['POST'])
@@ -96,19 +106,17 @@ def post():
     if not isinstance(values, list):
         values = [values]
 
-    billing_ids = []
+    new_billings = []
     for value in values:
         try:
-            new_billing = create_billing(value['order_id'])
+            new_billings.append(create_billing(value['order_id']))
         except KeyError:
             raise ValueError("missing mandatory parameter 'order_id'")
 
-        # trigger event
-        store.publish(Event('billing', 'created', **new_billing))
-
-        billing_ids.append(new_billing['id'])
+    # trigger events
+    store.publish_many([Event('billing', 'created', **new_billing) for new_billing in new_billings], _atomic=True)
 
-    return json.dumps(billing_ids)
+    return json.dumps([new_billing['id'] for new_billing in new_billings])
 
 
 @app.route('/billing/<billing_id>', methods=['PUT'])
@@ -0,0 +1,174 @@
+import argparse
+import json
+import random
+import time
+import uuid
+
+from lib.codec import CODECS
+from lib.event_store import Event, EventStore
+
+
+TOPIC = 'benchmark'
+
+
+def clear_cache(store):
+    """
+    Delete the domain model cache of the benchmark topic, but keep its snapshot.
+
+    :param store: An event store.
+    """
+    keys = [k for k in store.redis.scan_iter('{}_*'.format(TOPIC), count=10000) if k != '{}_snapshot'.format(TOPIC)]
+    for i in range(0, len(keys), 10000):
+        store.redis.delete(*keys[i:i + 10000])
+
+
+def clear(store):
+    """
+    Delete all events, snapshots and the domain model cache of the benchmark topic.
+
+    :param store: An event store.
+    """
+    clear_cache(store)
+    store.snapshots.delete(TOPIC)
+    store.redis.delete(*[store.key(TOPIC, action) for action in ('created', 'deleted', 'updated')])
+
+
+def seed(store, amount, entities):
+    """
+    Add events to the benchmark topic, i.e. one created event per entity and updated events for the rest.
+
+    :param store: An event store.
+    :param amount: The number of events.
+    :param entities: The number of entities.
+    """
+    ids = [str(uuid.uuid4()) for _ in range(entities)]
+    pipe = store.redis.pipeline(transaction=False)
+    for i in range(amount):
+        action = 'created' if i < entities else 'updated'
+        fields = {
+            'event_id': str(uuid.uuid4()),
+            'ts': '{0:.6f}'.format(time.time()),
+            'entity': json.dumps({
+                'id': ids[i % entities],
+                'product_ids': [str(uuid.uuid4()) for _ in range(3)],
+                'customer_id': str(uuid.uuid4())
+            })
+        }
+        if store.layout == EventStore.SINGLE:
+            fields['action'] = action
+        pipe.xadd(store.key(TOPIC, action), fields)
+        if len(pipe) >= 10000:
+            pipe.execute()
+    pipe.execute()
+
+
+def timed(func, *args):
+    """
+    Call a function and measure its duration.
+
+    :param func: The function to call.
+    :param args: The function arguments.
+    :return: The duration in seconds.
+    """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def benchmark_snapshots(store, amount, entities, tail):
+    """
+    Compare the cold start time, i.e. building the domain model cache, with and without a snapshot.
+
+    :param store: An event store.
+    :param amount: The number of events.
+    :param entities: The number of entities.
+    :param tail: The number of events published after the snapshot was taken.
+    """
+    clear(store)
+    seed(store, amount, entities)
+    print('seeded {} events for {} entities'.format(amount, entities))
+
+    print('cold start without snapshot: {:.2f}s'.format(timed(store.catch_up, TOPIC)))
+
+    print('taking snapshot: {:.2f}s'.format(timed(store.take_snapshot, TOPIC)))
+    seed(store, tail, min(entities, tail))
+    clear_cache(store)
+
+    print('cold start with snapshot and {} more events: {:.2f}s'.format(tail, timed(store.catch_up, TOPIC)))
+
+    clear(store)
+
+
+def order_inventory_mix(amount):
+    """
+    Create entities like the ones of the order and inventory topics, half of each.
+
+    :param amount: The number of entities.
+    :return: A list of entity dicts.
+    """
+    entities = []
+    for i in range(amount):
+        if i % 2:
+            entities.append({
+                'id': str(uuid.uuid4()),
+                'product_ids': [str(uuid.uuid4()) for _ in range(random.randint(1, 5))],
+                'customer_id': str(uuid.uuid4())
+            })
+        else:
+            entities.append({
+                'id': str(uuid.uuid4()),
+                'product_id': str(uuid.uuid4()),
+                'amount': random.randint(0, 1000)
+            })
+    return entities
+
+
+def benchmark_codecs(host, amount):
+    """
+    Compare the encode and decode throughput and the stream memory of all codecs.
+
+    :param host: The Redis host.
+    :param amount: The number of events.
+    """
+    entities = order_inventory_mix(amount)
+    for name in sorted(CODECS):
+        try:
+            store = EventStore(_host=host, _codec=name)
+        except ValueError as e:
+            print('skipping {}: {}'.format(name, e))
+            continue
+
+        start = time.time()
+        encoded = [store.codec.encode(entity) for entity in entities]
+        encode = time.time() - start
+        start = time.time()
+        for data in encoded:
+            store.codec.decode(data)
+        decode = time.time() - start
+
+        clear(store)
+        for i in range(0, amount, 10000):
+            store.publish_many([Event(TOPIC, 'created', **entity) for entity in entities[i:i + 10000]])
+        memory = store.redis.memory_usage(store.key(TOPIC, 'created'), samples=0)
+        clear(store)
+
+        print('{}: encode {:.0f}/s, decode {:.0f}/s, {} bytes per entity, stream {:.1f} MB'.format(
+            name, amount / encode, amount / decode, sum(len(d) for d in encoded) // amount, memory / 1048576.0))
+
+
+BENCHMARKS = {
+    'snapshots': lambda store, args: benchmark_snapshots(store, args.events, args.entities, args.tail),
+    'codecs': lambda store, args: benchmark_codecs(args.host, args.events)
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OrderShop event store benchmarks.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--entities', type=int, default=100000)
+    parser.add_argument('--tail', type=int, default=1000)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](EventStore(_host=args.host), args)
@@ -1,12 +1,14 @@
 import pprint
 import random
 import string
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
 import requests
 
-from common.utils import check_rsp_code
+from common.utils import Prefetch, check_rsp_code
 
 
 BASE_URL = 'http://localhost:5000'
@@ -179,6 +181,96 @@ class OrderShopTestCase(unittest.TestCase):
         # check result
         assert len(unbilled) == 8
 
+    @staticmethod
+    def test_A_reserve_inventory():
+
+        # load customers
+        rsp = requests.get('{}/customers'.format(BASE_URL))
+        check_rsp_code(rsp)
+        customers = rsp.json()
+
+        # load inventory of any product
+        rsp = requests.get('{}/inventory'.format(BASE_URL))
+        check_rsp_code(rsp)
+        inventory = rsp.json()[0]
+        order = {
+            "product_ids": [inventory['product_id']],
+            "customer_id": OrderShopTestCase.get_any_customer_id(customers)
+        }
+
+        # lower inventory
+        inventory['amount'] = 5
+        rsp = requests.put('{}/inventory/{}'.format(BASE_URL, inventory['id']), json=inventory)
+        check_rsp_code(rsp)
+
+        # order more than available
+        rsp = requests.post('{}/orders'.format(BASE_URL), json=dict(order, product_ids=order['product_ids'] * 6))
+        assert rsp.status_code != 200
+
+        # order concurrently
+        with ThreadPoolExecutor(10) as executor:
+            rsps = list(executor.map(lambda _: requests.post('{}/orders'.format(BASE_URL), json=order), range(10)))
+
+        # check result
+        assert len([r for r in rsps if r.status_code == 200]) == 5
+        OrderShopTestCase.wait_for('/inventory/{}'.format(inventory['id']), lambda x: int(x['amount']) == 0)
+
+    @staticmethod
+    def test_B_adjust_inventory():
+
+        # load customers
+        rsp = requests.get('{}/customers'.format(BASE_URL))
+        check_rsp_code(rsp)
+        customers = rsp.json()
+
+        # load inventory of any product
+        rsp = requests.get('{}/inventory'.format(BASE_URL))
+        check_rsp_code(rsp)
+        inventory = max(rsp.json(), key=lambda x: int(x['amount']))
+        inventory_url = '/inventory/{}'.format(inventory['id'])
+        amount = int(inventory['amount'])
+
+        # create order
+        order = {
+            "product_ids": [inventory['product_id']] * 3,
+            "customer_id": OrderShopTestCase.get_any_customer_id(customers)
+        }
+        rsp = requests.post('{}/orders'.format(BASE_URL), json=order)
+        check_rsp_code(rsp)
+        order_url = '/order/{}'.format(rsp.json()[0])
+        OrderShopTestCase.wait_for(order_url, lambda x: x)
+        OrderShopTestCase.wait_for(inventory_url, lambda x: int(x['amount']) == amount - 3)
+
+        # update order
+        order['product_ids'] = order['product_ids'][:1]
+        rsp = requests.put('{}{}'.format(BASE_URL, order_url), json=order)
+        check_rsp_code(rsp)
+        OrderShopTestCase.wait_for(order_url, lambda x: len(x['product_ids']) == 1)
+        OrderShopTestCase.wait_for(inventory_url, lambda x: int(x['amount']) == amount - 1)
+
+        # delete order
+        rsp = requests.delete('{}{}'.format(BASE_URL, order_url))
+        check_rsp_code(rsp)
+        OrderShopTestCase.wait_for(inventory_url, lambda x: int(x['amount']) == amount)
+
+    @staticmethod
+    def test_C_prefetch_for_slow_client():
+
+        # read two fast sections slower than their timeout, in bursts emptying the buffer
+        with ThreadPoolExecutor(2) as executor:
+            sections = [Prefetch(executor, OrderShopTestCase.read_slowly(100, 0.002), _size=10, _timeout=1)
+                        for _ in range(2)]
+            for section in sections:
+                items = []
+                for item in section:
+                    items.append(item)
+                    if item % 20 == 19:
+                        time.sleep(0.3)
+
+                # check result
+                assert items == list(range(100))
+                assert section.error is None
+
     @staticmethod
     def test_Z_print_report():
 
@@ -190,6 +282,22 @@ class OrderShopTestCase(unittest.TestCase):
         # print result
         pprint.pprint(report)
 
+    @staticmethod
+    def wait_for(path, check, timeout=5):
+        deadline = time.time() + timeout
+        rsp = requests.get('{}{}'.format(BASE_URL, path))
+        while not (rsp.status_code == 200 and check(rsp.json())) and time.time() < deadline:
+            time.sleep(0.1)
+            rsp = requests.get('{}{}'.format(BASE_URL, path))
+        check_rsp_code(rsp)
+        assert check(rsp.json())
+
+    @staticmethod
+    def read_slowly(amount, delay):
+        for i in range(amount):
+            time.sleep(delay)
+            yield i
+
     @staticmethod
     def create_customers(amount):
         customers = []
@@ -0,0 +1,95 @@
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 2))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+
+sessions = {}
+lock = threading.Lock()
+
+
+def session(_url):
+    """
+    Get the session of the host of a URL, i.e. a requests session keeping a pool of connections alive.
+
+    Failed connections are retried for all requests, failed reads and 502, 503 and 504 responses only for GET
+    and HEAD requests, as the PUT and DELETE commands of the services are not idempotent, e.g. adjust the inventory.
+
+    :param _url: The URL.
+    :return: The session.
+    """
+    host = urlsplit(_url).netloc
+    with lock:
+        if host not in sessions:
+            retry = Retry(total=RETRIES, backoff_factor=0.1, status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+            sessions[host] = requests.Session()
+            sessions[host].mount('http://', adapter)
+            sessions[host].mount('https://', adapter)
+        return sessions[host]
+
+
+def request(_method, _url, **_kwargs):
+    """
+    Send a request on the session of the host, with the default timeouts unless given.
+
+    :param _method: The HTTP method.
+    :param _url: The URL.
+    :param _kwargs: The arguments of requests.request.
+    :return: The response.
+    """
+    _kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session(_url).request(_method, _url, **_kwargs)
+
+
+def get(_url, **_kwargs):
+    """
+    Send a GET request, see request.
+
+    :param _url: The URL.
+    :param _kwargs: The arguments of requests.request.
+    :return: The response.
+    """
+    return request('GET', _url, **_kwargs)
+
+
+def post(_url, **_kwargs):
+    """
+    Send a POST request, see request.
+
+    :param _url: The URL.
+    :param _kwargs: The arguments of requests.request.
+    :return: The response.
+    """
+    return request('POST', _url, **_kwargs)
+
+
+def put(_url, **_kwargs):
+    """
+    Send a PUT request, see request.
+
+    :param _url: The URL.
+    :param _kwargs: The arguments of requests.request.
+    :return: The response.
+    """
+    return request('PUT', _url, **_kwargs)
+
+
+def delete(_url, **_kwargs):
+    """
+    Send a DELETE request, see request.
+
+    :param _url: The URL.
+    :param _kwargs: The arguments of requests.request.
+    :return: The response.
+    """
+    return request('DELETE', _url, **_kwargs)
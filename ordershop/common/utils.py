@@ -1,4 +1,8 @@
+import json
+import queue
 import sys
+import threading
+import time
 import traceback
 
 
@@ -18,3 +22,175 @@ def check_rsp_code(_rsp):
         return _rsp.text
     else:
         raise Exception(str(_rsp))
+
+
+def list_entities(_store, _topic, _args, _without=None):
+    """
+    List the entities of a topic, i.e. all of them or one page if a limit or cursor query parameter is given. The
+    limit is a hint, pages of small topics hold all entities.
+
+    :param _store: The event store.
+    :param _topic: The entity type.
+    :param _args: The query parameters.
+    :param _without: An optional tuple of another entity type and its indexed field, to only list entities not
+                     referenced by any of that type.
+    :return: The JSON list of entities, streamed if not paged, or with the status code and an X-Next-Cursor
+             header if paged.
+    """
+    if 'limit' not in _args and 'cursor' not in _args:
+        return json_array(_store.iter_all(_topic, _without=_without))
+
+    try:
+        limit = int(_args.get('limit', 1000))
+        cursor = int(_args.get('cursor', 0))
+    except ValueError:
+        raise ValueError("parameters 'limit' and 'cursor' must be integers")
+    if limit < 1 or cursor < 0:
+        raise ValueError("parameter 'limit' must be positive and 'cursor' must not be negative")
+
+    cursor, entities = _store.find_page(_topic, cursor, limit, _without)
+    return json.dumps(list(entities.values())), 200, {'X-Next-Cursor': str(cursor)}
+
+
+def json_array(_items, _batch=100):
+    """
+    Serialize items as a JSON array, a batch of items at a time.
+
+    :param _items: An iterable of items.
+    :param _batch: The number of items per chunk.
+    :return: A generator of JSON text chunks.
+    """
+    chunk = []
+    separator = ''
+    yield '['
+    try:
+        for item in _items:
+            chunk.append(json.dumps(item))
+            if len(chunk) == _batch:
+                yield separator + ', '.join(chunk)
+                chunk = []
+                separator = ', '
+    except Exception:
+
+        # keep the items read so far, e.g. for json_object
+        if chunk:
+            yield separator + ', '.join(chunk)
+        raise
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield ']'
+
+
+def json_object(_members, _errors=None):
+    """
+    Serialize members as a JSON object of JSON arrays, a batch of items at a time.
+
+    :param _members: A list of tuples of name and iterable of items.
+    :param _errors: An optional name of a member reporting the errors of the other members by name, i.e. a member
+                    failing while being read is cut short instead of failing the whole object.
+    :return: A generator of JSON text chunks.
+    """
+    errors = {}
+    separator = ''
+    yield '{'
+    for name, items in _members:
+        yield '{}{}: '.format(separator, json.dumps(name))
+        separator = ', '
+        try:
+            yield from json_array(items)
+        except Exception as e:
+            if _errors is None:
+                raise
+            errors[name] = str(e) or type(e).__name__
+            yield ']'
+    if _errors is not None:
+        yield '{}{}: {}'.format(separator, json.dumps(_errors), json.dumps(errors))
+    yield '}'
+
+
+class Prefetch(object):
+    """
+    Prefetch class, i.e. an iterator reading another iterator ahead on an executor, with a timeout.
+
+    Reading pauses while the buffer is full, i.e. without holding a worker of the executor, and is resumed on the
+    executor once half of the buffer is consumed.
+    """
+
+    def __init__(self, _executor, _items, _size=1000, _timeout=None):
+        """
+        :param _executor: The executor to read the items on.
+        :param _items: An iterable of items.
+        :param _size: The max. number of items read ahead.
+        :param _timeout: The number of seconds spent waiting for items to be read ahead after which reading the
+                         next item fails, None for no timeout. Time spent by the consumer does not count.
+        """
+        self.executor = _executor
+        self.items = iter(_items)
+        self.queue = queue.Queue(_size)
+        self.timeout = _timeout
+        self.waited = 0
+        self.closed = False
+        self.error = None
+        self.running = True
+        self.lock = threading.Lock()
+        _executor.submit(self.run)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.monotonic()
+        try:
+            more, value = self.queue.get(timeout=max(self.timeout - self.waited, 0) if self.timeout else None)
+        except queue.Empty:
+            self.close()
+            self.error = TimeoutError('timed out')
+            raise self.error
+        finally:
+            self.waited += time.monotonic() - start
+        if more:
+            self.resume()
+            return value
+        if value:
+            self.error = value
+            raise value
+        raise StopIteration
+
+    def run(self):
+        """
+        Read the items into the queue until it is full, all are read or the prefetch is closed.
+        """
+        try:
+            while not self.closed:
+                with self.lock:
+                    if self.queue.full():
+                        self.running = False
+                        return
+
+                # only this thread puts, so the queue has space
+                try:
+                    item = next(self.items)
+                except StopIteration:
+                    self.queue.put_nowait((False, None))
+                    return
+                self.queue.put_nowait((True, item))
+        except Exception as e:
+            self.queue.put_nowait((False, e))
+
+    def resume(self):
+        """
+        Continue reading on the executor, if reading paused and half of the queue is consumed.
+        """
+        if self.queue.qsize() > self.queue.maxsize // 2:
+            return
+        with self.lock:
+            if self.running or self.closed:
+                return
+            self.running = True
+        self.executor.submit(self.run)
+
+    def close(self):
+        """
+        Stop reading ahead.
+        """
+        self.closed = True
@@ -1,25 +1,27 @@
 import atexit
-import json
-
-import requests
 
+from common import http_client
 from common.utils import log_info, log_error
+from lib.codec import decode_entity
 from lib.event_store import EventStore
 
 
 store = EventStore()
 
+GROUP = 'crm-service'
+WORKERS = 4
+
 
 def customer_created(item):
     try:
-        msg_data = json.loads(item[1][0][1]['entity'])
+        msg_data = decode_entity(item[1][0][1])
         msg = """Dear {}!
 
 Welcome to Ordershop.
 
 Cheers""".format(msg_data['name'])
 
-        requests.post('http://msg-service:5000/email', json={
+        http_client.post('http://msg-service:5000/email', json={
             "to": msg_data['email'],
             "msg": msg
         })
@@ -29,14 +31,14 @@ Cheers""".format(msg_data['name'])
 
 def customer_deleted(item):
     try:
-        msg_data = json.loads(item[1][0][1]['entity'])
+        msg_data = decode_entity(item[1][0][1])
         msg = """Dear {}!
 
 Good bye, hope to see you soon again at Ordershop.
 
 Cheers""".format(msg_data['name'])
 
-        requests.post('http://msg-service:5000/email', json={
+        http_client.post('http://msg-service:5000/email', json={
             "to": msg_data['email'],
             "msg": msg
         })
@@ -46,9 +48,10 @@ Cheers""".format(msg_data['name'])
 
 def order_created(item):
     try:
-        msg_data = json.loads(item[1][0][1]['entity'])
+        msg_data = decode_entity(item[1][0][1])
         customer = store.find_one('customer', msg_data['customer_id'])
-        products = [store.find_one('product', product_id) for product_id in msg_data['product_ids']]
+        products = store.find_many('product', msg_data['product_ids'])
+        products = [products[product_id] for product_id in msg_data['product_ids']]
         msg = """Dear {}!
 
 Thank you for buying following {} products from Ordershop:
@@ -56,7 +59,7 @@ Thank you for buying following {} products from Ordershop:
 
 Cheers""".format(customer['name'], len(products), ", ".join([product['name'] for product in products]))
 
-        requests.post('http://msg-service:5000/email', json={
+        http_client.post('http://msg-service:5000/email', json={
             "to": customer['email'],
             "msg": msg
         })
@@ -65,18 +68,21 @@ Cheers""".format(customer['name'], len(products), ", ".join([product['name'] for
 
 
 def subscribe_to_domain_events():
-    store.subscribe('customer', 'created', customer_created)
-    store.subscribe('customer', 'deleted', customer_deleted)
-    store.subscribe('order', 'created', order_created)
+    store.subscribe('customer', 'created', customer_created, _group=GROUP, _workers=WORKERS)
+    store.subscribe('customer', 'deleted', customer_deleted, _group=GROUP, _workers=WORKERS)
+    store.subscribe('order', 'created', order_created, _group=GROUP, _workers=WORKERS)
     log_info('subscribed to domain events')
 
 
 def unsubscribe_from_domain_events():
-    store.unsubscribe('customer', 'created', customer_created)
-    store.unsubscribe('customer', 'deleted', customer_deleted)
-    store.unsubscribe('order', 'created', order_created)
+    store.unsubscribe('customer', 'created', customer_created, _group=GROUP)
+    store.unsubscribe('customer', 'deleted', customer_deleted, _group=GROUP)
+    store.unsubscribe('order', 'created', order_created, _group=GROUP)
     log_info('unsubscribed from domain events')
 
 
+for topic in ('customer', 'product'):
+    store.enable_cache(topic)
+    atexit.register(store.disable_cache, topic)
 subscribe_to_domain_events()
 atexit.register(unsubscribe_from_domain_events)
@@ -6,6 +6,7 @@ from flask import request
 from flask import Flask
 
 from common.factory import create_customer
+from common.utils import list_entities
 from lib.event_store import Event, EventStore
 
 
@@ -15,6 +16,8 @@ store = EventStore()
 if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     store.subscribe_to_entity_events('customer')
     atexit.register(store.unsubscribe_from_entity_events, 'customer')
+    store.enable_snapshots('customer')
+    store.enable_retention('customer')
 
 
 @app.route('/customers', methods=['GET'])
@@ -28,7 +31,7 @@ def get(customer_id=None):
 
         return json.dumps(customer) if customer else json.dumps(False)
     else:
-        return json.dumps([item for item in store.find_all('customer').values()])
+        return list_entities(store, 'customer', request.args)
 
 
 @app.route('/customer', methods=['POST'])
@@ -39,19 +42,17 @@ def post():
     if not isinstance(values, list):
         values = [values]
 
-    customer_ids = []
+    new_customers = []
     for value in values:
         try:
-            new_customer = create_customer(value['name'], value['email'])
+            new_customers.append(create_customer(value['name'], value['email']))
         except KeyError:
             raise ValueError("missing mandatory parameter 'name' and/or 'email'")
 
-        # trigger event
-        store.publish(Event('customer', 'created', **new_customer))
-
-        customer_ids.append(new_customer['id'])
+    # trigger events
+    store.publish_many([Event('customer', 'created', **new_customer) for new_customer in new_customers], _atomic=True)
 
-    return json.dumps(customer_ids)
+    return json.dumps([new_customer['id'] for new_customer in new_customers])
 
 
 @app.route('/customer/<customer_id>', methods=['PUT'])
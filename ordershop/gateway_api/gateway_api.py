@@ -1,17 +1,35 @@
+import atexit
+import hashlib
 import json
-
-import requests
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import request
 from flask import Flask
 
-from common.utils import check_rsp_code
+from common import http_client
+from common.utils import Prefetch, check_rsp_code, json_object, list_entities
+from lib.entity_cache import EntityCache
 from lib.event_store import EventStore
 
 
 app = Flask(__name__)
 store = EventStore()
 
+REPORT_TIMEOUT = float(os.environ.get('REPORT_TIMEOUT', 30))
+executor = ThreadPoolExecutor(int(os.environ.get('REPORT_WORKERS', 20)))
+REPORT_TOPICS = ('product', 'inventory', 'customer', 'order', 'billing')
+
+# responses by path and ETag, and the ETags of responses sent completely
+responses = EntityCache(int(os.environ.get('RESPONSE_CACHE_SIZE', 32)), float(os.environ.get('RESPONSE_CACHE_TTL', 5)))
+etags = EntityCache(10000, None)
+
+
+if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    for topic in ('customer', 'product'):
+        store.enable_cache(topic)
+        atexit.register(store.disable_cache, topic)
+
 
 def proxy_command_request(_base_url):
     """
@@ -28,7 +46,7 @@ def proxy_command_request(_base_url):
         except Exception:
             raise ValueError("cannot parse json body {}".format(request.data))
 
-        rsp = requests.post(_base_url.format(request.full_path), json=values)
+        rsp = http_client.post(_base_url.format(request.full_path), json=values)
         return check_rsp_code(rsp)
 
     # handle PUT
@@ -39,15 +57,76 @@ def proxy_command_request(_base_url):
         except Exception:
             raise ValueError("cannot parse json body {}".format(request.data))
 
-        rsp = requests.put(_base_url.format(request.full_path), json=values)
+        rsp = http_client.put(_base_url.format(request.full_path), json=values)
         return check_rsp_code(rsp)
 
     # handle DELETE
     if request.method == 'DELETE':
-        rsp = requests.delete(_base_url.format(request.full_path))
+        rsp = http_client.delete(_base_url.format(request.full_path))
         return check_rsp_code(rsp)
 
 
+def conditional(_topics, _render, _complete=None):
+    """
+    Helper function to answer a GET request with an ETag of the version of the topics it reads, i.e. with 304 Not
+    Modified if the client has got this version, else from the response cache or by rendering the response.
+
+    The version is read before rendering, so a response is at least as recent as its ETag. A response is only
+    cached, and its ETag only honoured, once it has been sent completely.
+
+    :param _topics: The entity types the response is made of.
+    :param _render: A function returning the response.
+    :param _complete: An optional function telling if a streamed response was complete, i.e. not cut short.
+    :return: The response.
+    """
+    etag = hashlib.sha1(store.version(_topics).encode('utf-8')).hexdigest()
+    key = (request.full_path, etag)
+    sent, _, sent_generation = etags.get_many([key])
+
+    if sent and etag in request.if_none_match:
+        rsp = app.make_response(('', 304))
+
+    else:
+
+        # read from cache
+        cached, _, generation = responses.get_many([key])
+        if cached:
+            rsp = app.make_response(cached[key])
+        else:
+            rsp = app.make_response(_render())
+            if rsp.status_code == 200:
+                rsp.response = record(key, rsp.response, rsp.headers.copy(), generation, sent_generation, _complete)
+
+    rsp.set_etag(etag)
+    return rsp
+
+
+def record(_key, _body, _headers, _generation, _sent_generation, _complete):
+    """
+    Helper function to cache a response while it is sent, see conditional.
+
+    :param _key: The tuple of path and ETag.
+    :param _body: The iterable of body chunks.
+    :param _headers: The response headers.
+    :param _generation: The generation of the response cache.
+    :param _sent_generation: The generation of the ETag cache.
+    :param _complete: An optional function telling if the response was complete.
+    :return: A generator of the body chunks.
+    """
+    chunks = []
+    try:
+        for chunk in _body:
+            chunks.append(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(_body, 'close'):
+            _body.close()
+
+    if not _complete or _complete():
+        responses.put_many({_key: (b''.join(chunks), 200, _headers)}, _generation)
+        etags.put_many({_key: True}, _sent_generation)
+
+
 @app.route('/billings', methods=['GET'])
 @app.route('/billing/<billing_id>', methods=['GET'])
 def billing_query(billing_id=None):
@@ -56,8 +135,7 @@ def billing_query(billing_id=None):
         billing = store.find_one('billing', billing_id)
         return json.dumps(billing) if billing else json.dumps(False)
     else:
-        billings = store.find_all('billing').values()
-        return json.dumps(list(billings))
+        return conditional(('billing',), lambda: list_entities(store, 'billing', request.args))
 
 
 @app.route('/billing', methods=['POST'])
@@ -77,8 +155,7 @@ def customer_query(customer_id=None):
         customer = store.find_one('customer', customer_id)
         return json.dumps(customer) if customer else json.dumps(False)
     else:
-        customers = store.find_all('customer').values()
-        return json.dumps(list(customers))
+        return conditional(('customer',), lambda: list_entities(store, 'customer', request.args))
 
 
 @app.route('/customer', methods=['POST'])
@@ -98,8 +175,7 @@ def product_query(product_id=None):
         product = store.find_one('product', product_id) or False
         return json.dumps(product) if product else json.dumps(False)
     else:
-        products = store.find_all('product').values()
-        return json.dumps(list(products))
+        return conditional(('product',), lambda: list_entities(store, 'product', request.args))
 
 
 @app.route('/product', methods=['POST'])
@@ -119,8 +195,7 @@ def inventory_query(inventory_id=None):
         inventory = store.find_one('inventory', inventory_id) or False
         return json.dumps(inventory) if inventory else json.dumps(False)
     else:
-        inventory = store.find_all('inventory').values()
-        return json.dumps(list(inventory))
+        return conditional(('inventory',), lambda: list_entities(store, 'inventory', request.args))
 
 
 @app.route('/inventory', methods=['POST'])
@@ -140,12 +215,17 @@ def order_query(order_id=None):
         order = store.find_one('order', order_id)
         return json.dumps(order) if order else json.dumps(False)
     elif request.path.endswith('/orders/unbilled'):
-        rsp = requests.get('http://order-service:5000/orders/unbilled')
-        check_rsp_code(rsp)
-        return rsp.text
+        return conditional(('order', 'billing'), unbilled_orders)
     else:
-        orders = store.find_all('order').values()
-        return json.dumps(list(orders))
+        return conditional(('order',), lambda: list_entities(store, 'order', request.args))
+
+
+def unbilled_orders():
+    rsp = http_client.get('http://order-service:5000{}'.format(request.full_path))
+    check_rsp_code(rsp)
+    if 'X-Next-Cursor' in rsp.headers:
+        return rsp.text, 200, {'X-Next-Cursor': rsp.headers['X-Next-Cursor']}
+    return rsp.text
 
 
 @app.route('/order', methods=['POST'])
@@ -160,18 +240,27 @@ def order_command(order_id=None):
 @app.route('/report', methods=['GET'])
 def report():
 
-    products = store.find_all('product')
-    inventory = store.find_all('inventory')
-    customers = store.find_all('customer')
-    orders = store.find_all('order')
-    billings = store.find_all('billing')
-
-    result = {
-        "products": list(products.values()),
-        "inventory": list(inventory.values()),
-        "customers": list(customers.values()),
-        "orders": list(orders.values()),
-        "billings": list(billings.values())
-    }
-
-    return json.dumps(result)
+    sections = []
+    return conditional(REPORT_TOPICS, lambda: render_report(sections),
+                       lambda: not any(section.error for _, section in sections))
+
+
+def render_report(_sections):
+
+    # read all sections concurrently, each one with a timeout
+    _sections[:] = [
+        ("products", Prefetch(executor, store.iter_all('product'), _timeout=REPORT_TIMEOUT)),
+        ("inventory", Prefetch(executor, store.iter_all('inventory'), _timeout=REPORT_TIMEOUT)),
+        ("customers", Prefetch(executor, store.iter_all('customer'), _timeout=REPORT_TIMEOUT)),
+        ("orders", Prefetch(executor, store.iter_all('order'), _timeout=REPORT_TIMEOUT)),
+        ("billings", Prefetch(executor, store.iter_all('billing'), _timeout=REPORT_TIMEOUT))
+    ]
+
+    def generate():
+        try:
+            yield from json_object(_sections, "errors")
+        finally:
+            for _, section in _sections:
+                section.close()
+
+    return generate()
@@ -6,16 +6,21 @@ from flask import request
 from flask import Flask
 
 from common.factory import create_inventory
+from common.utils import list_entities
 from lib.event_store import Event, EventStore
+from lib.stock import Stock
 
 
 app = Flask(__name__)
 store = EventStore()
+stock = Stock(store)
 
 
 if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     store.subscribe_to_entity_events('inventory')
     atexit.register(store.unsubscribe_from_entity_events, 'inventory')
+    store.enable_snapshots('inventory')
+    store.enable_retention('inventory')
 
 
 @app.route('/inventory', methods=['GET'])
@@ -29,7 +34,7 @@ def get(inventory_id=None):
 
         return json.dumps(inventory) if inventory else json.dumps(False)
     else:
-        return json.dumps([item for item in store.find_all('inventory').values()])
+        return list_entities(store, 'inventory', request.args)
 
 
 @app.route('/inventory', methods=['POST'])
@@ -39,19 +44,17 @@ def post():
     if not isinstance(values, list):
         values = [values]
 
-    inventory_ids = []
+    new_inventorys = []
     for value in values:
         try:
-            new_inventory = create_inventory(value['product_id'], value['amount'])
+            new_inventorys.append(create_inventory(value['product_id'], value['amount']))
         except KeyError:
             raise ValueError("missing mandatory parameter 'product_id' and/or 'amount'")
 
-        # trigger event
-        store.publish(Event('inventory', 'created', **new_inventory))
-
-        inventory_ids.append(new_inventory['id'])
+    # trigger events
+    stock.publish([Event('inventory', 'created', **new_inventory) for new_inventory in new_inventorys])
 
-    return json.dumps(inventory_ids)
+    return json.dumps([new_inventory['id'] for new_inventory in new_inventorys])
 
 
 @app.route('/inventory/<inventory_id>', methods=['PUT'])
@@ -66,7 +69,7 @@ def put(inventory_id):
     inventory['id'] = inventory_id
 
     # trigger event
-    store.publish(Event('inventory', 'updated', **inventory))
+    stock.publish([Event('inventory', 'updated', **inventory)])
 
     return json.dumps(True)
 
@@ -78,7 +81,7 @@ def delete(inventory_id):
     if inventory:
 
         # trigger event
-        store.publish(Event('inventory', 'deleted', **inventory))
+        stock.publish([Event('inventory', 'deleted', **inventory)])
 
         return json.dumps(True)
     else:
@@ -89,38 +92,14 @@ def delete(inventory_id):
 @app.route('/incr/<product_id>/<value>', methods=['POST'])
 def incr(product_id, value=None):
 
-    inventory = list(filter(lambda x: x['product_id'] == product_id, store.find_all('inventory').values()))
-    if not inventory:
-        raise ValueError("could not find inventory")
-
-    inventory = inventory[0]
-    inventory['amount'] = int(inventory['amount']) - (value if value else 1)
-
-    # trigger event
-    store.publish(Event('inventory', 'updated', **inventory))
-
-    return json.dumps(True)
+    return json.dumps(stock.reserve({product_id: -int(value or 1)}))
 
 
 @app.route('/decr/<product_id>', methods=['POST'])
 @app.route('/decr/<product_id>/<value>', methods=['POST'])
 def decr(product_id, value=None):
 
-    inventory = list(filter(lambda x: x['product_id'] == product_id, store.find_all('inventory').values()))
-    if not inventory:
-        raise ValueError("could not find inventory")
-
-    inventory = inventory[0]
-    if int(inventory['amount']) - (value if value else 1) >= 0:
-
-        inventory['amount'] = int(inventory['amount']) - (value if value else 1)
-
-        # trigger event
-        store.publish(Event('inventory', 'updated', **inventory))
-
-        return json.dumps(True)
-    else:
-        return json.dumps(False)
+    return json.dumps(stock.reserve({product_id: int(value or 1)}))
 
 
 @app.route('/decr_from_order', methods=['POST'])
@@ -137,31 +116,22 @@ def decr_from_order():
         except KeyError:
             raise ValueError("missing mandatory parameter 'product_ids'")
 
-        for inventory in store.find_all('inventory').values():
+        for product_id in product_ids:
+            occurs[product_id] = occurs.get(product_id, 0) + 1
 
-            if not inventory['product_id'] in occurs:
-                occurs[inventory['product_id']] = 0
+    return json.dumps(stock.reserve(occurs))
 
-            occurs[inventory['product_id']] += product_ids.count(inventory['product_id'])
-            if occurs[inventory['product_id']] <= int(inventory['amount']):
-                continue
-            else:
-                return json.dumps(False)
 
-    for k, v in occurs.items():
-        inventory = list(filter(lambda x: x['product_id'] == k, store.find_all('inventory').values()))
-        if not inventory:
-            raise ValueError("could not find inventory")
+@app.route('/adjust', methods=['POST'])
+def adjust():
 
-        inventory = inventory[0]
-        if int(inventory['amount']) - v >= 0:
-
-            inventory['amount'] = int(inventory['amount']) - v
-
-            # trigger event
-            store.publish(Event('inventory', 'updated', **inventory))
+    values = request.get_json()
+    if not isinstance(values, dict):
+        raise ValueError("body must be a json object mapping product ids to amounts")
 
-        else:
-            return json.dumps(False)
+    try:
+        amounts = dict((product_id, int(amount)) for product_id, amount in values.items() if int(amount))
+    except (TypeError, ValueError):
+        raise ValueError("amounts must be integers")
 
-    return json.dumps(True)
+    return json.dumps(stock.reserve(amounts))
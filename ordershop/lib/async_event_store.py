@@ -0,0 +1,301 @@
+import asyncio
+import os
+
+from redis.asyncio import StrictRedis
+
+from common.utils import log_error
+from lib.codec import JSON, decode_entity, get_codec
+from lib.domain_model import AsyncDomainModel
+from lib.event_store import (SERVER_IDS, SINGLE, SPLIT, TS_IDS, aggregate, event_entries, event_entry, replay_streams,
+                             stream_key)
+from lib.snapshots import Snapshots
+
+
+class AsyncEventStore(object):
+    """
+    Event Store class for asyncio, sharing streams, domain model cache and snapshots with EventStore.
+    """
+    chunk_size = 1000
+    count = 1000
+
+    def __init__(self, _layout=None, _host='redis', _ids=None, _codec=None):
+        """
+        :param _layout: The stream layout, see EventStore.
+        :param _host: The Redis host.
+        :param _ids: The stream entry ids, see EventStore.
+        :param _codec: The name of the codec to publish event entities with, see EventStore.
+        """
+        self.redis = StrictRedis(decode_responses=True, encoding_errors='surrogateescape', host=_host)
+        self.raw_redis = StrictRedis(host=_host)
+        self.layout = _layout or os.environ.get('EVENT_STORE_LAYOUT', SPLIT)
+        if self.layout not in (SPLIT, SINGLE):
+            raise ValueError('unknown stream layout: {}'.format(self.layout))
+        self.ids = _ids or os.environ.get('EVENT_STORE_IDS', SERVER_IDS)
+        if self.ids not in (SERVER_IDS, TS_IDS):
+            raise ValueError('unknown stream entry ids: {}'.format(self.ids))
+        self.codec = get_codec(_codec or os.environ.get('EVENT_STORE_CODEC', JSON))
+        self.domain_model = AsyncDomainModel(self.redis)
+        self.streams = {}
+        self.subscriptions = {}
+        self.reader = None
+
+    async def publish(self, _event):
+        """
+        Publish an event.
+
+        :param _event: The event to publish.
+        :return: Success.
+        """
+        entry_id, fields = event_entry(self.layout, _event, self.ids, self.codec)
+
+        return await self.redis.xadd(self.key(_event.topic, _event.action), fields, id=entry_id)
+
+    async def publish_many(self, _events, _atomic=False):
+        """
+        Publish many events in one round trip, see EventStore.publish_many.
+
+        :param _events: The events to publish.
+        :param _atomic: Publish all events in one MULTI/EXEC transaction.
+        :return: A list of the stream entry ids.
+        """
+        pipe = self.redis.pipeline(transaction=_atomic)
+        for key, entry_id, fields in event_entries(self.layout, _events, self.ids, self.codec):
+            pipe.xadd(key, fields, id=entry_id)
+
+        return await pipe.execute()
+
+    def key(self, _topic, _action):
+        """
+        Get the key of the stream holding the events of a topic and action.
+
+        :param _topic: The event topic.
+        :param _action: The event action.
+        :return: The stream key.
+        """
+        return stream_key(self.layout, _topic, _action)
+
+    async def subscribe(self, _topic, _action, _last_id='$', _maxsize=1000):
+        """
+        Subscribe to an event channel.
+
+        All channels are read by one task, i.e. with one XREAD over all subscribed streams, a subscription which
+        is not consumed blocks the others once its queue is full, until it is closed.
+
+        :param _topic: The event topic.
+        :param _action: The event action.
+        :param _last_id: The stream entry id to start after, if the stream is not subscribed to yet.
+        :param _maxsize: The max. number of entries queued for the subscription.
+        :return: A Subscription, i.e. an async iterator of lists of the stream key and a list of one entry.
+        """
+        key = self.key(_topic, _action)
+        if key not in self.streams:
+            if _last_id == '$':
+                last = await self.redis.xrevrange(key, count=1)
+                _last_id = last[0][0] if last else '0-0'
+            self.streams[key] = _last_id
+
+        subscription = Subscription(self, key, _action if self.layout == SINGLE else None, _maxsize)
+        self.subscriptions.setdefault(key, set()).add(subscription)
+        if not self.reader:
+            self.reader = asyncio.ensure_future(self._dispatch())
+
+        return subscription
+
+    def unsubscribe(self, _subscription):
+        """
+        Unsubscribe from an event channel.
+
+        :param _subscription: The subscription.
+        :return: Success.
+        """
+        subscriptions = self.subscriptions.get(_subscription.key, set())
+        if _subscription not in subscriptions:
+            return False
+
+        subscriptions.remove(_subscription)
+        if not subscriptions:
+            del self.subscriptions[_subscription.key]
+            del self.streams[_subscription.key]
+        _subscription.closed = True
+
+        # drop the queued entries, so the dispatcher is not blocked by a full queue
+        while not _subscription.queue.empty():
+            _subscription.queue.get_nowait()
+        _subscription.queue.put_nowait(None)
+
+        return True
+
+    async def _dispatch(self):
+        """
+        Poll all subscribed event streams and put their entries into the queues of the subscriptions.
+        """
+        while self.streams:
+            try:
+                items = await self.redis.xread(dict(self.streams), count=self.count, block=1000) or []
+            except Exception as e:
+                log_error(e)
+                await asyncio.sleep(1)
+                continue
+
+            for key, entries in items:
+                if key not in self.streams:
+                    continue
+                self.streams[key] = entries[-1][0]
+                for entry in entries:
+                    for subscription in list(self.subscriptions.get(key, ())):
+                        if not subscription.action or entry[1].get('action') == subscription.action:
+                            await subscription.put([key, [entry]])
+
+        self.reader = None
+
+    async def find_one(self, _topic, _id):
+        """
+        Find an event from a topic with an specific id.
+
+        :param _topic: The event topic.
+        :param _id: The event id.
+        :return: The event dict.
+        """
+        return (await self.find_many(_topic, [_id])).get(_id)
+
+    async def find_many(self, _topic, _ids):
+        """
+        Find aggregated events from a topic with specific ids, i.e. from the cache, which is built once if needed.
+
+        :param _topic: The event topic.
+        :param _ids: The event ids, repeated ids are only looked up once.
+        :return: A dict mapping id -> dict of aggregated events, ids not found are omitted.
+        """
+        _ids = list(dict.fromkeys(_ids))
+
+        # write into cache
+        if not await self.domain_model.exists(_topic):
+            await self.catch_up(_topic)
+
+        return await self.domain_model.retrieve_many(_topic, _ids)
+
+    async def find_all(self, _topic):
+        """
+        Find all aggregated events for a topic.
+
+        :param _topic: The event topic.
+        :return: A dict mapping id -> dict of all aggregated events.
+        """
+
+        result = {}
+
+        # read from cache
+        if await self.domain_model.exists(_topic):
+            result = await self.domain_model.retrieve(_topic)
+
+        if not result:
+
+            # write into cache
+            await self.catch_up(_topic)
+            result = await self.domain_model.retrieve(_topic)
+
+        return result
+
+    async def catch_up(self, _topic):
+        """
+        Apply all events published since the last checkpoint of a topic to the cache, see EventStore.catch_up.
+
+        :param _topic: The event topic.
+        :return: A dict mapping stream key -> id of the last stream entry applied.
+        """
+        checkpoint = await self.domain_model.checkpoint(_topic)
+        updated = {}
+        deleted = {}
+
+        # start from the latest snapshot
+        if not checkpoint:
+            updated, checkpoint = Snapshots.decode(await self.raw_redis.get(Snapshots.key(_topic)))
+
+        async for key, entry_id, action, entity in self._replay_events(_topic, checkpoint):
+            aggregate(updated, action, entity, deleted)
+            checkpoint[key] = entry_id
+
+        if updated or deleted:
+            await self.domain_model.apply(_topic, updated.values(), deleted.values(), checkpoint)
+
+        return checkpoint
+
+    async def _replay_events(self, _topic, _checkpoint=None):
+        """
+        Read all events of a topic in replay order, see EventStore._replay_events.
+
+        :param _topic: The event topic.
+        :param _checkpoint: An optional dict mapping stream key -> stream entry id to start after.
+        :return: An async generator of tuples of stream key, stream entry id, action and entity dict.
+        """
+        checkpoint = _checkpoint or {}
+        for key, action in replay_streams(self.layout, _topic):
+            start = '({}'.format(checkpoint[key]) if checkpoint.get(key) else '-'
+            while True:
+                events = await self.redis.xrange(key, start, count=self.chunk_size)
+                for entry_id, fields in events:
+                    yield key, entry_id, action or fields['action'], decode_entity(fields)
+                if len(events) < self.chunk_size:
+                    break
+                start = '({}'.format(events[-1][0])
+
+    async def close(self):
+        """
+        Close all subscriptions and connections.
+        """
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                self.unsubscribe(subscription)
+        if self.reader:
+            self.reader.cancel()
+        await self.redis.aclose()
+        await self.raw_redis.aclose()
+
+
+class Subscription(object):
+    """
+    Subscription class, i.e. an async iterator of the entries of an event channel.
+    """
+
+    def __init__(self, _store, _key, _action, _maxsize):
+        """
+        :param _store: The async event store.
+        :param _key: The stream key.
+        :param _action: The action to filter entries by, None if the stream only has entries of one action.
+        :param _maxsize: The max. number of queued entries.
+        """
+        self.store = _store
+        self.key = _key
+        self.action = _action
+        self.queue = asyncio.Queue(_maxsize)
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def put(self, _item):
+        """
+        Queue an item, waiting for space unless the subscription is closed in the meantime.
+
+        :param _item: A list of the stream key and a list of one entry.
+        """
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.queue.put(_item), 1)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    async def __anext__(self):
+        if self.closed and self.queue.empty():
+            raise StopAsyncIteration
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        """
+        Unsubscribe.
+        """
+        self.store.unsubscribe(self)
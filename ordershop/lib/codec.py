@@ -0,0 +1,110 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+class JsonCodec(object):
+    """
+    JSON Codec class, i.e. entities as JSON text, readable by any consumer.
+    """
+    name = JSON
+
+    @staticmethod
+    def encode(_entity):
+        """
+        Encode an entity.
+
+        :param _entity: The entity dict.
+        :return: The encoded entity.
+        """
+        return json.dumps(_entity)
+
+    @staticmethod
+    def decode(_data):
+        """
+        Decode an entity.
+
+        :param _data: The encoded entity.
+        :return: The entity dict.
+        """
+        return json.loads(_data)
+
+
+class MsgpackCodec(object):
+    """
+    MessagePack Codec class, i.e. entities as compact binary, requires the msgpack package.
+    """
+    name = MSGPACK
+
+    @staticmethod
+    def encode(_entity):
+        """
+        Encode an entity.
+
+        :param _entity: The entity dict.
+        :return: The encoded entity.
+        """
+        return msgpack.packb(_entity)
+
+    @staticmethod
+    def decode(_data):
+        """
+        Decode an entity.
+
+        :param _data: The encoded entity, as bytes or as str decoded with the surrogateescape error handler.
+        :return: The entity dict.
+        """
+        if isinstance(_data, str):
+            _data = _data.encode('utf-8', 'surrogateescape')
+        return msgpack.unpackb(_data)
+
+
+CODECS = {
+    JSON: JsonCodec,
+    MSGPACK: MsgpackCodec
+}
+
+
+def get_codec(_name):
+    """
+    Get a codec by name.
+
+    :param _name: The codec name.
+    :return: The codec.
+    """
+    if _name not in CODECS:
+        raise ValueError('unknown codec: {}'.format(_name))
+    if _name == MSGPACK and not msgpack:
+        raise ValueError('codec {} requires the msgpack package'.format(_name))
+    return CODECS[_name]
+
+
+def encode_entity(_codec, _entity):
+    """
+    Get the stream entry fields of an entity.
+
+    :param _codec: The codec.
+    :param _entity: The entity dict.
+    :return: A dict with the encoded entity and the codec name, which is omitted for JSON.
+    """
+    fields = {'entity': _codec.encode(_entity)}
+    if _codec is not JsonCodec:
+        fields['codec'] = _codec.name
+    return fields
+
+
+def decode_entity(_fields):
+    """
+    Get the entity of a stream entry, i.e. decode it with the codec recorded in the entry.
+
+    :param _fields: The stream entry fields.
+    :return: The entity dict.
+    """
+    return get_codec(_fields.get('codec', JSON)).decode(_fields['entity'])
@@ -1,3 +1,13 @@
+TYPE_PREFIX = '_type:'
+
+# the indexed fields per type of entity, maintained by every process applying events
+INDEXES = {
+    'billing': ('order_id',),
+    'inventory': ('product_id',),
+    'order': ('customer_id',)
+}
+
+
 def is_key(_value):
     """
     Check if a value is a key, i.e. has to be looked up on Redis root level.
@@ -8,110 +18,417 @@ def is_key(_value):
     return '_' in _value and ':' in _value
 
 
+def execute(_program):
+    """
+    Run a program, i.e. a generator yielding redis pipelines and receiving their results, on a redis client.
+
+    :param _program: The program.
+    :return: The return value of the program.
+    """
+    try:
+        pipe = next(_program)
+        while True:
+            pipe = _program.send(pipe.execute())
+    except StopIteration as e:
+        return e.value
+
+
+async def execute_async(_program):
+    """
+    Run a program, i.e. a generator yielding redis pipelines and receiving their results, on an asyncio redis
+    client.
+
+    :param _program: The program.
+    :return: The return value of the program.
+    """
+    try:
+        pipe = next(_program)
+        while True:
+            pipe = _program.send(await pipe.execute())
+    except StopIteration as e:
+        return e.value
+
+
+def index_key(_topic, _field, _value):
+    """
+    Get the key of the index entry of a field value, i.e. the set of ids of the entities with that value.
+
+    :param _topic: The type of entity.
+    :param _field: The indexed field.
+    :param _value: The field value.
+    :return: The index key.
+    """
+    return '{}_by_{}:{}'.format(_topic, _field, _value)
+
+
 class DomainModel(object):
     """
     Domain Model class.
     """
     redis = None
+    batch_size = 1000
 
-    def __init__(self, _redis):
+    def __init__(self, _redis, _batch_size=None, _indexes=None):
         """
 
         :param _redis: A redis instance.
+        :param _batch_size: The max. number of entities fetched per pipelined round trip.
+        :param _indexes: A dict mapping type of entity -> tuple of indexed fields, defaults to INDEXES.
         """
         self.redis = _redis
+        if _batch_size:
+            self.batch_size = _batch_size
+        self.indexes = INDEXES if _indexes is None else _indexes
 
-    def create(self, _topic, _values):
+    def create(self, _topic, _values, _checkpoint=None):
         """
         Set an entity.
 
         :param _topic: The type of entity.
         :param _values: The entity properties.
+        :param _checkpoint: An optional dict mapping stream key -> id of the last stream entry applied.
         """
-        self.redis.sadd('{}_ids'.format(_topic), _values['id'])
-        for k, v in _values.items():
-            if isinstance(v, list):
-                lid = '{}_{}:{}'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, lid)
-                self.redis.rpush(lid, *v)
-            elif isinstance(v, set):
-                sid = '{}_{}:{}.'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, sid)
-                self.redis.sadd(sid, *v)
-            elif isinstance(v, dict):
-                did = '{}_{}:{}.'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, did)
-                self.redis.hmset(did, v)
-            else:
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, v)
+        return self.apply(_topic, [_values], _checkpoint=_checkpoint)
+
+    def apply(self, _topic, _updated, _deleted=(), _checkpoint=None):
+        """
+        Set and delete many entities at once, e.g. when (re)building the cache from the event streams.
+
+        :param _topic: The type of entity.
+        :param _updated: An iterable of entity properties to set.
+        :param _deleted: An iterable of entity properties to delete.
+        :param _checkpoint: An optional dict mapping stream key -> id of the last stream entry applied.
+        """
+        return execute(self._apply(_topic, _updated, _deleted, _checkpoint))
+
+    def _apply(self, _topic, _updated, _deleted, _checkpoint):
+        """
+        Program setting and deleting many entities in one transaction, see apply. The indexed fields of the
+        entities are read first, to move them in the indexes.
+        """
+        updated = list(_updated)
+        deleted = list(_deleted)
+        fields = self.indexes.get(_topic, ())
+        indexed = {}
+        if fields and (updated or deleted):
+            ids = [values['id'] for values in updated + deleted]
+            pipe = self.redis.pipeline(transaction=False)
+            for eid in ids:
+                pipe.hmget('{}_entity:{}'.format(_topic, eid), *fields)
+            indexed = dict(zip(ids, (yield pipe)))
+
+        pipe = self.redis.pipeline()
+        ids = []
+        for values in updated:
+            self._set(pipe, _topic, values)
+            self._index(pipe, _topic, fields, values['id'], indexed.get(values['id']), values)
+            ids.append(values['id'])
+        if ids:
+            pipe.sadd('{}_ids'.format(_topic), *ids)
+        for values in deleted:
+            self._remove(pipe, _topic, values)
+            self._index(pipe, _topic, fields, values['id'], indexed.get(values['id']), {})
+        if _checkpoint:
+            pipe.hset('{}_checkpoint'.format(_topic), mapping=_checkpoint)
+        yield pipe
 
     def retrieve(self, _topic):
         """
-        Get an entity.
+        Get all entities.
 
         :param _topic: The type of entity.
-        :return: A dict with the entity properties.
+        :return: A dict mapping id -> dict with the entity properties.
         """
+        return self.retrieve_many(_topic, self.redis.smembers('{}_ids'.format(_topic)))
+
+    def retrieve_page(self, _topic, _cursor=0, _count=1000, _without=None):
+        """
+        Get a page of entities, i.e. the entities of one SSCAN of the ids.
+
+        :param _topic: The type of entity.
+        :param _cursor: The cursor returned for the previous page, 0 for the first page.
+        :param _count: The approx. number of entities per page.
+        :param _without: An optional tuple of another type of entity and its indexed field, to only get entities
+                         not referenced by any entity of that type, e.g. ('billing', 'order_id').
+        :return: A tuple of the cursor of the next page, 0 after the last page, and a dict mapping id -> dict with
+                 the entity properties.
+        """
+        cursor, ids = self.redis.sscan('{}_ids'.format(_topic), _cursor, count=_count)
+        if _without and ids:
+            self.ensure_index(*_without)
+            pipe = self.redis.pipeline(transaction=False)
+            for eid in ids:
+                pipe.exists(index_key(_without[0], _without[1], eid))
+            ids = [eid for eid, referenced in zip(ids, pipe.execute()) if not referenced]
+        return cursor, self.retrieve_many(_topic, ids)
+
+    def retrieve_many(self, _topic, _ids):
+        """
+        Get entities by id, using a fixed number of pipelined round trips per batch of ids.
+
+        :param _topic: The type of entity.
+        :param _ids: An iterable of entity ids.
+        :return: A dict mapping id -> dict with the entity properties, ids not found are omitted.
+        """
+        return execute(self._retrieve_many(_topic, _ids))
+
+    def _retrieve_many(self, _topic, _ids):
+        """
+        Program getting entities by id, see retrieve_many.
+        """
+        ids = list(_ids)
         result = {}
-        for eid in self.redis.smembers('{}_ids'.format(_topic)):
-            result[eid] = self.redis.hgetall('{}_entity:{}'.format(_topic, eid))
-            for k, v in result[eid].items():
-                if is_key(v):
-                    rtype = self.redis.type(v)
-                    if rtype == 'list':
-                        result[eid][k] = self.redis.lrange(v, 0, -1)
-                    elif rtype == 'set':
-                        result[eid][k] = self.redis.smembers(v)
-                    elif rtype == 'hash':
-                        result[eid][k] = self.redis.hgetall(v)
-                    else:
-                        raise ValueError('unknown redis type: {}'.format(rtype))
+        for i in range(0, len(ids), self.batch_size):
+            result.update((yield from self._retrieve_batch(_topic, ids[i:i + self.batch_size])))
         return result
 
-    def update(self, _topic, _values):
+    def _retrieve_batch(self, _topic, _ids):
+        """
+        Program getting a batch of entities, i.e. all hashes in one round trip and all nested collections in
+        another.
+
+        :param _topic: The type of entity.
+        :param _ids: A list of entity ids.
+        :return: A dict mapping id -> dict with the entity properties.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for eid in _ids:
+            pipe.hgetall('{}_entity:{}'.format(_topic, eid))
+
+        result = {}
+        nested = []
+        for eid, values in zip(_ids, (yield pipe)):
+            if not values:
+                continue
+            entity = {}
+            for k, v in values.items():
+                if k.startswith(TYPE_PREFIX):
+                    continue
+                entity[k] = v
+                rtype = values.get(TYPE_PREFIX + k)
+                if rtype or is_key(v):
+                    nested.append((entity, k, v, rtype))
+            result[eid] = entity
+
+        # entities cached without type information need a type probe
+        legacy = [n for n in nested if not n[3]]
+        if legacy:
+            pipe = self.redis.pipeline(transaction=False)
+            for _, _, v, _ in legacy:
+                pipe.type(v)
+            rtypes = dict(zip([n[2] for n in legacy], (yield pipe)))
+            nested = [(e, k, v, rtype or rtypes[v]) for e, k, v, rtype in nested]
+
+        if nested:
+            pipe = self.redis.pipeline(transaction=False)
+            for _, _, v, rtype in nested:
+                if rtype == 'list':
+                    pipe.lrange(v, 0, -1)
+                elif rtype == 'set':
+                    pipe.smembers(v)
+                elif rtype == 'hash':
+                    pipe.hgetall(v)
+                else:
+                    raise ValueError('unknown redis type: {}'.format(rtype))
+            for (entity, k, _, _), value in zip(nested, (yield pipe)):
+                entity[k] = value
+
+        return result
+
+    def update(self, _topic, _values, _checkpoint=None):
         """
         Delete and set an entity.
 
         :param _topic: The type of entity.
         :param _values: The entity properties.
+        :param _checkpoint: An optional dict mapping stream key -> id of the last stream entry applied.
         """
-        for k, v in _values.items():
-            if isinstance(v, list):
-                lid = '{}_{}:{}'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, lid)
-                self.redis.delete(lid)
-                self.redis.rpush(lid, *v)
-            elif isinstance(v, set):
-                sid = '{}_{}:{}'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, sid)
-                self.redis.delete(sid)
-                self.redis.sadd(sid, *v)
-            elif isinstance(v, dict):
-                did = '{}_{}:{}'.format(_topic, k, _values['id'])
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, did)
-                self.redis.delete(did)
-                self.redis.hmset(did, *v)
-            else:
-                self.redis.hset('{}_entity:{}'.format(_topic, _values['id']), k, v)
+        return self.apply(_topic, [_values], _checkpoint=_checkpoint)
 
-    def delete(self, _topic, _values):
+    def delete(self, _topic, _values, _checkpoint=None):
         """
         Delete an entity.
 
+        :param _topic: The type of entity.
+        :param _values: The entity properties.
+        :param _checkpoint: An optional dict mapping stream key -> id of the last stream entry applied.
+        """
+        return self.apply(_topic, (), [_values], _checkpoint)
+
+    def find_by(self, _topic, _field, _value):
+        """
+        Get entities by the value of an indexed field, building the index first if it was declared after the
+        entities were cached.
+
+        :param _topic: The type of entity.
+        :param _field: The indexed field.
+        :param _value: The field value.
+        :return: A dict mapping id -> dict with the entity properties.
+        """
+        self.ensure_index(_topic, _field)
+
+        # drop stale index entries of a concurrent reindex
+        entities = self.retrieve_many(_topic, self.redis.smembers(index_key(_topic, _field, _value)))
+        return dict((k, v) for k, v in entities.items() if v.get(_field) == str(_value))
+
+    def ensure_index(self, _topic, _field):
+        """
+        Check that a field is indexed and build its index if it was declared after the entities were cached.
+
+        :param _topic: The type of entity.
+        :param _field: The indexed field.
+        """
+        if _field not in self.indexes.get(_topic, ()):
+            raise ValueError('{} entities are not indexed by {}'.format(_topic, _field))
+        if not self.redis.sismember('{}_indexes'.format(_topic), _field):
+            self.reindex(_topic)
+
+    def reindex(self, _topic):
+        """
+        Build the indexes of all cached entities of a type.
+
+        :param _topic: The type of entity.
+        """
+        fields = self.indexes.get(_topic, ())
+        cursor = None
+        while cursor != 0:
+            cursor, ids = self.redis.sscan('{}_ids'.format(_topic), cursor or 0, count=self.batch_size)
+            pipe = self.redis.pipeline(transaction=False)
+            for eid in ids:
+                pipe.hmget('{}_entity:{}'.format(_topic, eid), *fields)
+            values = pipe.execute()
+            pipe = self.redis.pipeline(transaction=False)
+            for eid, indexed in zip(ids, values):
+                for field, value in zip(fields, indexed):
+                    if value is not None:
+                        pipe.sadd(index_key(_topic, field, value), eid)
+            pipe.execute()
+        if fields:
+            self.redis.sadd('{}_indexes'.format(_topic), *fields)
+
+    def exists(self, _topic):
+        """
+        Check if the entities of a type are cached, i.e. the cache has been built (even if it is empty now).
+
+        :param _topic: The type of entity.
+        :return: True iff the entities are cached, else False.
+        """
+        return bool(self.redis.exists('{}_ids'.format(_topic), '{}_checkpoint'.format(_topic)))
+
+    def checkpoint(self, _topic):
+        """
+        Get the ids of the last stream entries applied to the cache.
+
+        :param _topic: The type of entity.
+        :return: A dict mapping stream key -> stream entry id, empty if the cache has not been built yet.
+        """
+        return self.redis.hgetall('{}_checkpoint'.format(_topic))
+
+    @staticmethod
+    def _set(_pipe, _topic, _values):
+        """
+        Queue all commands needed to (re)write an entity on a pipeline.
+
+        The entity hash and its nested collections are replaced as a whole, so executing the pipeline as a
+        transaction never exposes a half-written entity. The type of each nested collection is kept in the
+        entity hash, so reading it back needs no TYPE probe.
+
+        :param _pipe: A redis pipeline.
         :param _topic: The type of entity.
         :param _values: The entity properties.
         """
-        self.redis.srem('{}_ids'.format(_topic), 1, _values['id'])
-        self.redis.delete('{}_entity:{}'.format(_topic, _values['id']))
+        eid = _values['id']
+        key = '{}_entity:{}'.format(_topic, eid)
+        fields = {}
         for k, v in _values.items():
             if isinstance(v, (list, set, dict)):
-                self.redis.delete('{}_{}:{}'.format(_topic, k, _values['id']))
+                nid = '{}_{}:{}'.format(_topic, k, eid)
+                fields[k] = nid
+                _pipe.delete(nid)
+                if isinstance(v, list):
+                    fields[TYPE_PREFIX + k] = 'list'
+                    if v:
+                        _pipe.rpush(nid, *v)
+                elif isinstance(v, set):
+                    fields[TYPE_PREFIX + k] = 'set'
+                    if v:
+                        _pipe.sadd(nid, *v)
+                else:
+                    fields[TYPE_PREFIX + k] = 'hash'
+                    if v:
+                        _pipe.hset(nid, mapping=v)
+            else:
+                fields[k] = v
+        _pipe.delete(key)
+        _pipe.hset(key, mapping=fields)
 
-    def exists(self, _topic):
+    @staticmethod
+    def _index(_pipe, _topic, _fields, _id, _old, _values):
+        """
+        Queue all commands needed to move an entity in the indexes on a pipeline.
+
+        :param _pipe: A redis pipeline.
+        :param _topic: The type of entity.
+        :param _fields: The indexed fields.
+        :param _id: The entity id.
+        :param _old: A list of the cached values of the indexed fields, None if the entity is not cached.
+        :param _values: The new entity properties, empty if the entity is deleted.
+        """
+        for field, old in zip(_fields, _old or [None] * len(_fields)):
+            new = _values.get(field)
+            new = None if new is None else str(new)
+            if old is not None and old != new:
+                _pipe.srem(index_key(_topic, field, old), _id)
+            if new is not None:
+                _pipe.sadd(index_key(_topic, field, new), _id)
+
+    @staticmethod
+    def _remove(_pipe, _topic, _values):
         """
-        Check if an entity exists.
+        Queue all commands needed to delete an entity on a pipeline.
 
+        :param _pipe: A redis pipeline.
         :param _topic: The type of entity.
-        :return: True iff an entity exists, else False.
+        :param _values: The entity properties.
+        """
+        _pipe.srem('{}_ids'.format(_topic), _values['id'])
+        _pipe.delete('{}_entity:{}'.format(_topic, _values['id']))
+        for k, v in _values.items():
+            if isinstance(v, (list, set, dict)):
+                _pipe.delete('{}_{}:{}'.format(_topic, k, _values['id']))
+
+
+class AsyncDomainModel(DomainModel):
+    """
+    Domain Model class for an asyncio redis client, sharing the key layout with DomainModel.
+    """
+
+    async def apply(self, _topic, _updated, _deleted=(), _checkpoint=None):
+        """
+        Set and delete many entities at once, see DomainModel.apply.
+        """
+        return await execute_async(self._apply(_topic, _updated, _deleted, _checkpoint))
+
+    async def retrieve(self, _topic):
+        """
+        Get all entities, see DomainModel.retrieve.
+        """
+        return await self.retrieve_many(_topic, await self.redis.smembers('{}_ids'.format(_topic)))
+
+    async def retrieve_many(self, _topic, _ids):
+        """
+        Get entities by id, see DomainModel.retrieve_many.
+        """
+        return await execute_async(self._retrieve_many(_topic, _ids))
+
+    async def exists(self, _topic):
+        """
+        Check if the entities of a type are cached, see DomainModel.exists.
+        """
+        return bool(await self.redis.exists('{}_ids'.format(_topic), '{}_checkpoint'.format(_topic)))
+
+    async def checkpoint(self, _topic):
+        """
+        Get the ids of the last stream entries applied to the cache, see DomainModel.checkpoint.
         """
-        return self.redis.exists('{}_ids'.format(_topic))
+        return await self.redis.hgetall('{}_checkpoint'.format(_topic))
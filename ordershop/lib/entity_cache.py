@@ -0,0 +1,117 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class EntityCache(object):
+    """
+    Entity Cache class, i.e. a bounded in-process LRU cache with an optional TTL.
+    """
+
+    def __init__(self, _size=10000, _ttl=60):
+        """
+        :param _size: The max. number of cached entities, least recently used ones are evicted first.
+        :param _ttl: The max. number of seconds an entity is cached, None for no expiry.
+        """
+        self.size = _size
+        self.ttl = _ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, _ids):
+        """
+        Get cached entities.
+
+        :param _ids: The entity ids.
+        :return: A tuple of a dict mapping id -> entity for all hits but deleted entities, a list of missed ids and
+                 the cache generation to pass to put_many when loading the missed ids.
+        """
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self.lock:
+            for eid in _ids:
+                entry = self.entries.get(eid)
+                if entry and (entry[0] is None or entry[0] > now):
+                    self.entries.move_to_end(eid)
+                    if entry[1] is not None:
+                        found[eid] = copy.deepcopy(entry[1])
+                    self.hits += 1
+                else:
+                    if entry:
+                        del self.entries[eid]
+                        self.evictions += 1
+                    missing.append(eid)
+                    self.misses += 1
+            generation = self.generation
+        return found, missing, generation
+
+    def put_many(self, _entities, _generation):
+        """
+        Cache entities which were loaded after a miss.
+
+        Nothing is cached if any entity was invalidated in the meantime, as the loaded values might be stale.
+
+        :param _entities: A dict mapping id -> entity.
+        :param _generation: The cache generation returned by get_many.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if _generation != self.generation:
+                return
+            for eid, entity in _entities.items():
+                self.entries[eid] = (expires, copy.deepcopy(entity))
+                self.entries.move_to_end(eid)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_many(self, _entities, _deleted=()):
+        """
+        Cache entities as published, i.e. replacing what might have been loaded before, and remember deleted
+        entities, so they are not loaded again while the deletion is not applied everywhere.
+
+        :param _entities: A dict mapping id -> entity.
+        :param _deleted: An iterable of ids of deleted entities.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            for eid, entity in _entities.items():
+                self.entries[eid] = (expires, copy.deepcopy(entity))
+                self.entries.move_to_end(eid)
+            for eid in _deleted:
+                self.entries[eid] = (expires, None)
+                self.entries.move_to_end(eid)
+            self.generation += 1
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, _id):
+        """
+        Drop a cached entity.
+
+        :param _id: The entity id.
+        """
+        with self.lock:
+            self.entries.pop(_id, None)
+            self.generation += 1
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        :return: A dict with the number of cached entities, hits, misses and evictions.
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -1,12 +1,20 @@
 import functools
-import json
+import itertools
+import os
+import socket
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from redis import StrictRedis
+from redis.exceptions import ResponseError
 
+from common.utils import log_error, log_info
+from lib.codec import JSON, JsonCodec, decode_entity, encode_entity, get_codec
 from lib.domain_model import DomainModel
+from lib.entity_cache import EntityCache
+from lib.snapshots import Snapshots
 
 
 class Event(object):
@@ -27,15 +35,150 @@ class Event(object):
         self.entity = _entity
 
 
+SPLIT = 'split'
+SINGLE = 'single'
+SERVER_IDS = 'server'
+TS_IDS = 'ts'
+ACTIONS = ('created', 'deleted', 'updated')
+
+
+def stream_key(_layout, _topic, _action):
+    """
+    Get the key of the stream holding the events of a topic and action.
+
+    :param _layout: The stream layout.
+    :param _topic: The event topic.
+    :param _action: The event action.
+    :return: The stream key.
+    """
+    if _layout == SINGLE:
+        return 'events:{}'.format(_topic)
+    return 'events:{}_{}'.format(_topic, _action)
+
+
+def replay_streams(_layout, _topic):
+    """
+    Get the streams holding the events of a topic in replay order, i.e. the one stream of the SINGLE layout and
+    the created, deleted and updated streams one after the other for the SPLIT layout.
+
+    :param _layout: The stream layout.
+    :param _topic: The event topic.
+    :return: A list of tuples of stream key and action, None if the action is an entry field.
+    """
+    if _layout == SINGLE:
+        return [(stream_key(_layout, _topic, None), None)]
+    return [(stream_key(_layout, _topic, action), action) for action in ACTIONS]
+
+
+def event_entry(_layout, _event, _ids=SERVER_IDS, _codec=JsonCodec):
+    """
+    Get the stream entry of an event.
+
+    :param _layout: The stream layout.
+    :param _event: The event.
+    :param _ids: The stream entry ids, i.e. SERVER_IDS for ids assigned by Redis or TS_IDS for ids derived from
+                 the event timestamp.
+    :param _codec: The codec of the event entity.
+    :return: A tuple of stream entry id and stream entry fields.
+    """
+    fields = {'event_id': _event.id, 'ts': '{0:.6f}'.format(_event.ts)}
+    fields.update(encode_entity(_codec, _event.entity))
+    if _layout == SINGLE:
+        fields['action'] = _event.action
+    if _ids == TS_IDS:
+        return fields['ts'].replace('.', '-'), fields
+    return '*', fields
+
+
+def event_entries(_layout, _events, _ids=SERVER_IDS, _codec=JsonCodec):
+    """
+    Get the stream entries of many events, i.e. with timestamp ids made strictly increasing per stream, as events
+    created in a loop can share a timestamp.
+
+    :param _layout: The stream layout.
+    :param _events: The events.
+    :param _ids: The stream entry ids, see event_entry.
+    :param _codec: The codec of the event entities.
+    :return: A list of tuples of stream key, stream entry id and stream entry fields.
+    """
+    entries = []
+    last = {}
+    for event in _events:
+        key = stream_key(_layout, event.topic, event.action)
+        entry_id, fields = event_entry(_layout, event, _ids, _codec)
+        if entry_id == '*':
+            entries.append((key, entry_id, fields))
+            continue
+        ms, seq = map(int, entry_id.split('-'))
+        if key in last and (ms, seq) <= last[key]:
+            ms, seq = last[key][0], last[key][1] + 1
+        last[key] = (ms, seq)
+        entries.append((key, '{}-{}'.format(ms, seq), fields))
+    return entries
+
+
+def aggregate(_entities, _action, _entity, _deleted=None):
+    """
+    Apply an event to aggregated entities.
+
+    :param _entities: A dict mapping id -> entity to update.
+    :param _action: The event action.
+    :param _entity: The event entity.
+    :param _deleted: An optional dict mapping id -> entity of deleted entities to update.
+    """
+    if _action == 'deleted':
+        _entities.pop(_entity['id'], None)
+        if _deleted is not None:
+            _deleted[_entity['id']] = _entity
+    else:
+        _entities[_entity['id']] = _entity
+        if _deleted is not None:
+            _deleted.pop(_entity['id'], None)
+
+
 class EventStore(object):
     """
     Event Store class.
     """
+    chunk_size = 1000
 
-    def __init__(self):
-        self.redis = StrictRedis(decode_responses=True, host='redis')
+    SPLIT = SPLIT
+    SINGLE = SINGLE
+    SERVER_IDS = SERVER_IDS
+    TS_IDS = TS_IDS
+
+    def __init__(self, _layout=None, _host='redis', _ids=None, _codec=None):
+        """
+        :param _layout: The stream layout, i.e. SPLIT for one stream per topic and action or SINGLE for one
+                        ordered stream per topic, defaults to the EVENT_STORE_LAYOUT environment variable.
+        :param _host: The Redis host.
+        :param _ids: The stream entry ids, i.e. SERVER_IDS for ids assigned by Redis or TS_IDS for ids derived from
+                     the event timestamp, which fails for events of the same microsecond, defaults to the
+                     EVENT_STORE_IDS environment variable.
+        :param _codec: The name of the codec to publish event entities with, see lib.codec, defaults to the
+                       EVENT_STORE_CODEC environment variable. Entities are read with the codec they were published
+                       with.
+        """
+
+        # keep binary entities readable, see MsgpackCodec.decode
+        self.redis = StrictRedis(decode_responses=True, encoding_errors='surrogateescape', host=_host)
+        self.layout = _layout or os.environ.get('EVENT_STORE_LAYOUT', EventStore.SPLIT)
+        if self.layout not in (EventStore.SPLIT, EventStore.SINGLE):
+            raise ValueError('unknown stream layout: {}'.format(self.layout))
+        self.ids = _ids or os.environ.get('EVENT_STORE_IDS', EventStore.SERVER_IDS)
+        if self.ids not in (EventStore.SERVER_IDS, EventStore.TS_IDS):
+            raise ValueError('unknown stream entry ids: {}'.format(self.ids))
+        self.codec = get_codec(_codec or os.environ.get('EVENT_STORE_CODEC', JSON))
         self.subscribers = {}
+        self.entity_handlers = {}
+        self.cache_handlers = {}
+        self.caches = {}
+        self.snapshot_policies = {}
+        self.snapshot_lock = threading.Lock()
+        self.retention_policies = {}
+        self.retention_stats = {}
         self.domain_model = DomainModel(self.redis)
+        self.snapshots = Snapshots(StrictRedis(host=_host))
 
     def publish(self, _event):
         """
@@ -44,47 +187,84 @@ class EventStore(object):
         :param _event: The event to publish.
         :return: Success.
         """
-        key = 'events:{}_{}'.format(_event.topic, _event.action)
-        entity = json.dumps(_event.entity)
-        entry_id = '{0:.6f}'.format(_event.ts).replace('.', '-')
+        entry_id, fields = event_entry(self.layout, _event, self.ids, self.codec)
+
+        return self.redis.xadd(self.key(_event.topic, _event.action), fields, id=entry_id)
+
+    def publish_many(self, _events, _atomic=False):
+        """
+        Publish many events in one round trip.
 
-        return self.redis.xadd(key, {'event_id': _event.id, 'entity': entity}, id=entry_id)
+        :param _events: The events to publish.
+        :param _atomic: Publish all events in one MULTI/EXEC transaction, i.e. other clients see all or none of them.
+        :return: A list of the stream entry ids.
+        """
+        pipe = self.redis.pipeline(transaction=_atomic)
+        for key, entry_id, fields in event_entries(self.layout, _events, self.ids, self.codec):
+            pipe.xadd(key, fields, id=entry_id)
+
+        return pipe.execute()
 
-    def subscribe(self, _topic, _action, _handler):
+    def key(self, _topic, _action):
+        """
+        Get the key of the stream holding the events of a topic and action.
+
+        :param _topic: The event topic.
+        :param _action: The event action.
+        :return: The stream key.
+        """
+        return stream_key(self.layout, _topic, _action)
+
+    def subscribe(self, _topic, _action, _handler, _last_id='$', _group=None, _workers=1):
         """
         Subscribe to an event channel.
 
+        All channels are read by one subscriber thread (per consumer group), i.e. with one XREAD (or XREADGROUP)
+        over all subscribed streams.
+
+        With a consumer group, each event is handled by only one of the processes subscribed with the same group
+        and acknowledged afterwards, events published while no process was subscribed are handled when one
+        subscribes again and events not acknowledged in time are claimed by another process.
+
         :param _topic: The event topic.
         :param _action: The event action.
         :param _handler: The event handler.
+        :param _last_id: The stream entry id to start after, if the stream is not subscribed to yet.
+        :param _group: An optional consumer group name, e.g. the name of the service.
+        :param _workers: The number of threads calling the handlers, if the consumer group is not subscribed yet.
         :return: Success.
         """
-        if (_topic, _action) in self.subscribers:
-            self.subscribers[(_topic, _action)].add_handler(_handler)
+        action = _action if self.layout == EventStore.SINGLE else None
+        subscriber = self.subscribers.get(_group)
+        if subscriber:
+            subscriber.add_handler(self.key(_topic, _action), action, _handler, _last_id)
         else:
-            subscriber = Subscriber(_topic, _action, _handler, self.redis)
+            subscriber = Subscriber(self.redis, _group, _workers)
+            subscriber.add_handler(self.key(_topic, _action), action, _handler, _last_id)
             subscriber.start()
-            self.subscribers[(_topic, _action)] = subscriber
+            self.subscribers[_group] = subscriber
 
         return True
 
-    def unsubscribe(self, _topic, _action, _handler):
+    def unsubscribe(self, _topic, _action, _handler, _group=None):
         """
         Unsubscribe from an event channel.
 
         :param _topic: The event topic.
         :param _action: The event action.
         :param _handler: The event handler.
+        :param _group: The consumer group name used to subscribe, if any.
         :return: Success.
         """
-        subscriber = self.subscribers.get((_topic, _action))
+        subscriber = self.subscribers.get(_group)
         if not subscriber:
             return False
 
-        subscriber.rem_handler(_handler)
+        action = _action if self.layout == EventStore.SINGLE else None
+        subscriber.rem_handler(self.key(_topic, _action), action, _handler)
         if not subscriber:
             subscriber.stop()
-            del self.subscribers[(_topic, _action)]
+            del self.subscribers[_group]
 
         return True
 
@@ -96,7 +276,44 @@ class EventStore(object):
         :param _id: The event id.
         :return: The event dict.
         """
-        return self.find_all(_topic).get(_id)
+        return self.find_many(_topic, [_id]).get(_id)
+
+    def find_many(self, _topic, _ids):
+        """
+        Find aggregated events from a topic with specific ids, i.e. from the cache, which is built once if needed.
+
+        :param _topic: The event topic.
+        :param _ids: The event ids, repeated ids are only looked up once.
+        :return: A dict mapping id -> dict of aggregated events, ids not found are omitted.
+        """
+        _ids = list(dict.fromkeys(_ids))
+        cache = self.caches.get(_topic)
+        if not cache:
+            return self._find_many(_topic, _ids)
+
+        # read from in-process cache
+        result, missing, generation = cache.get_many(_ids)
+        if missing:
+            loaded = self._find_many(_topic, missing)
+            cache.put_many(loaded, generation)
+            result.update(loaded)
+
+        return result
+
+    def _find_many(self, _topic, _ids):
+        """
+        Find aggregated events from a topic with specific ids on Redis.
+
+        :param _topic: The event topic.
+        :param _ids: The event ids.
+        :return: A dict mapping id -> dict of aggregated events, ids not found are omitted.
+        """
+
+        # write into cache
+        if not self.domain_model.exists(_topic):
+            self.catch_up(_topic)
+
+        return self.domain_model.retrieve_many(_topic, _ids)
 
     def find_all(self, _topic):
         """
@@ -114,41 +331,400 @@ class EventStore(object):
 
         if not result:
 
-            # get created entities
-            created_events = self.redis.xrange('events:{}_created'.format(_topic))
-            if created_events:
-                created_entities = map(lambda x: json.loads(x[1]['entity']), created_events)
-                result = dict(map(lambda x: (x['id'], x), created_entities))
-
-            # remove deleted entities
-            deleted_events = self.redis.xrange('events:{}_deleted'.format(_topic))
-            if deleted_events:
-                deleted_entities = map(lambda x: json.loads(x[1]['entity']), deleted_events)
-                deleted_entities = map(lambda x: x['id'], deleted_entities)
-                result = EventStore.remove_deleted(result, deleted_entities)
-
-            # set updated entities
-            updated_events = self.redis.xrange('events:{}_updated'.format(_topic))
-            if updated_events:
-                updated_entities = map(lambda x: json.loads(x[1]['entity']), updated_events)
-                updated_entities = dict(map(lambda x: (x['id'], x), updated_entities))
-                result = EventStore.set_updated(result, updated_entities)
-
             # write into cache
-            for k, v in result.items():
-                self.domain_model.create(_topic, v)
+            self.catch_up(_topic)
+            result = self.domain_model.retrieve(_topic)
 
         return result
 
+    def find_by(self, _topic, _field, _value):
+        """
+        Find aggregated events from a topic by the value of an indexed field, see lib.domain_model.INDEXES.
+
+        :param _topic: The event topic.
+        :param _field: The indexed field.
+        :param _value: The field value.
+        :return: A dict mapping id -> dict of aggregated events.
+        """
+
+        # write into cache
+        if not self.domain_model.exists(_topic):
+            self.catch_up(_topic)
+
+        return self.domain_model.find_by(_topic, _field, _value)
+
+    def find_page(self, _topic, _cursor=0, _limit=1000, _without=None):
+        """
+        Find a page of aggregated events for a topic.
+
+        :param _topic: The event topic.
+        :param _cursor: The cursor returned for the previous page, 0 for the first page.
+        :param _limit: The approx. number of aggregated events per page, less if _without filters some.
+        :param _without: An optional tuple of another topic and its indexed field, to only find aggregated events
+                         not referenced by any of that topic, e.g. ('billing', 'order_id').
+        :return: A tuple of the cursor of the next page, 0 after the last page, and a dict mapping id -> dict of
+                 aggregated events.
+        """
+
+        # write into cache
+        for topic in (_topic, _without[0]) if _without else (_topic,):
+            if not self.domain_model.exists(topic):
+                self.catch_up(topic)
+
+        return self.domain_model.retrieve_page(_topic, _cursor, _limit, _without)
+
+    def iter_all(self, _topic, _page_size=1000, _cursor=0, _without=None):
+        """
+        Iterate over all aggregated events for a topic page by page, i.e. without loading them all at once. An
+        entity changed during the iteration may be returned more than once.
+
+        :param _topic: The event topic.
+        :param _page_size: The approx. number of aggregated events per page.
+        :param _cursor: The cursor of the page to start with, 0 for the first page.
+        :param _without: An optional tuple of another topic and its indexed field, see find_page.
+        :return: A generator of dicts of aggregated events.
+        """
+        while True:
+            _cursor, entities = self.find_page(_topic, _cursor, _page_size, _without)
+            for entity in entities.values():
+                yield entity
+            if not _cursor:
+                break
+
+    def version(self, _topics):
+        """
+        Get the version of the aggregated events of topics in one round trip, i.e. a token which changes whenever
+        any of them changes.
+
+        It is made of the ids of the last stream entries applied to the cache, as aggregated events are read from
+        there, or of the last stream entries if the cache of a topic has not been built yet.
+
+        :param _topics: The event topics.
+        :return: The version string.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for topic in _topics:
+            pipe.hgetall('{}_checkpoint'.format(topic))
+            for key, _ in replay_streams(self.layout, topic):
+                pipe.xrevrange(key, count=1)
+        results = iter(pipe.execute())
+
+        version = []
+        for topic in _topics:
+            checkpoint = next(results)
+            for key, _ in replay_streams(self.layout, topic):
+                last = next(results)
+                if checkpoint:
+                    version.append(checkpoint.get(key, '0-0'))
+                else:
+                    version.append(last[0][0] if last else '0-0')
+
+        return ','.join(version)
+
+    def catch_up(self, _topic):
+        """
+        Apply all events published since the last checkpoint of a topic to the cache, i.e. build it if there is
+        no checkpoint yet.
+
+        :param _topic: The event topic.
+        :return: A dict mapping stream key -> id of the last stream entry applied.
+        """
+        checkpoint = self.domain_model.checkpoint(_topic)
+        updated = {}
+        deleted = {}
+
+        # start from the latest snapshot
+        if not checkpoint:
+            updated, checkpoint = self.snapshots.load(_topic)
+
+        for key, entry_id, action, entity in self._replay_events(_topic, checkpoint):
+            aggregate(updated, action, entity, deleted)
+            checkpoint[key] = entry_id
+
+        if updated or deleted:
+            self.domain_model.apply(_topic, updated.values(), deleted.values(), checkpoint)
+
+        return checkpoint
+
+    def _replay_events(self, _topic, _checkpoint=None):
+        """
+        Read all events of a topic in replay order, i.e. in publishing order for the SINGLE layout and created,
+        deleted, updated events one stream after the other for the SPLIT layout.
+
+        :param _topic: The event topic.
+        :param _checkpoint: An optional dict mapping stream key -> stream entry id to start after.
+        :return: A generator of tuples of stream key, stream entry id, action and entity dict.
+        """
+        checkpoint = _checkpoint or {}
+        for key, action in replay_streams(self.layout, _topic):
+            for entry_id, fields in self._read(key, checkpoint.get(key)):
+                yield key, entry_id, action or fields['action'], decode_entity(fields)
+
+    def _read(self, _key, _last_id=None):
+        """
+        Read an event stream in chunks.
+
+        :param _key: The stream key.
+        :param _last_id: The stream entry id to start after, None to read from the beginning.
+        :return: A generator of tuples of stream entry id and entry fields.
+        """
+        start = '({}'.format(_last_id) if _last_id else '-'
+        while True:
+            events = self.redis.xrange(_key, start, count=self.chunk_size)
+            for event in events:
+                yield event
+            if len(events) < self.chunk_size:
+                break
+            start = '({}'.format(events[-1][0])
+
+    def take_snapshot(self, _topic):
+        """
+        Take a snapshot of all aggregated events for a topic, i.e. replay the events since the previous snapshot
+        onto it. Only one process at a time takes a snapshot of a topic.
+
+        :param _topic: The event topic.
+        :return: True iff a snapshot was taken.
+        """
+        lock = self.redis.lock('{}_snapshot_lock'.format(_topic), timeout=600, blocking=False)
+        if not lock.acquire():
+            return False
+
+        try:
+            entities, checkpoint = self.snapshots.load(_topic)
+            for key, entry_id, action, entity in self._replay_events(_topic, checkpoint):
+                aggregate(entities, action, entity)
+                checkpoint[key] = entry_id
+            size = self.snapshots.save(_topic, entities, checkpoint)
+            log_info('took snapshot of {} {} entities ({} bytes)'.format(len(entities), _topic, size))
+        finally:
+            lock.release()
+
+        return True
+
+    def enable_snapshots(self, _topic, _every=10000, _interval=3600):
+        """
+        Take snapshots of a topic periodically, i.e. after a number of events or an amount of time, whatever
+        comes first. Entity events are counted by the entity event handlers.
+
+        :param _topic: The entity type.
+        :param _every: The number of events after which to take a snapshot, None to not count events.
+        :param _interval: The number of seconds after which to take a snapshot (if there were any events), None
+                          to not take snapshots by time.
+        """
+        self.snapshot_policies[_topic] = {'every': _every, 'interval': _interval, 'count': 0, 'ts': time.time()}
+        if _topic not in self.entity_handlers:
+            self.subscribe_to_entity_events(_topic)
+
+    def _snapshot_if_due(self, _topic, _count=1):
+        """
+        Count entity events and take a snapshot in the background if the snapshot policy says so.
+
+        :param _topic: The entity type.
+        :param _count: The number of events.
+        """
+        policy = self.snapshot_policies.get(_topic)
+        if not policy:
+            return
+
+        with self.snapshot_lock:
+            policy['count'] += _count
+            due = (policy['every'] and policy['count'] >= policy['every']) or \
+                (policy['interval'] and time.time() - policy['ts'] >= policy['interval'])
+            if due:
+                policy['count'] = 0
+                policy['ts'] = time.time()
+
+        if due:
+            threading.Thread(target=self._snapshot_and_compact, args=(_topic,), daemon=True).start()
+
+    def _snapshot_and_compact(self, _topic):
+        """
+        Take a snapshot of a topic and remove the events it covers if the retention policy says so.
+
+        :param _topic: The entity type.
+        """
+        try:
+            if self.take_snapshot(_topic) and _topic in self.retention_policies:
+                policy = self.retention_policies[_topic]
+                self.compact(_topic, policy['maxlen'], policy['max_age'], policy['compact'])
+        except Exception as e:
+            log_error(e)
+
+    def enable_retention(self, _topic, _maxlen=None, _max_age=None, _compact=True):
+        """
+        Remove events of a topic in the background after each snapshot, see compact. Enables snapshots with
+        the default policy if they are not enabled yet.
+
+        :param _topic: The entity type.
+        :param _maxlen: The number of events to keep per stream, None to not trim by length.
+        :param _max_age: The number of seconds to keep events, None to not trim by age.
+        :param _compact: Remove events superseded by a later event of the same entity.
+        """
+        self.retention_policies[_topic] = {'maxlen': _maxlen, 'max_age': _max_age, 'compact': _compact}
+        if _topic not in self.snapshot_policies:
+            self.enable_snapshots(_topic)
+
+    def compact(self, _topic, _maxlen=None, _max_age=None, _compact=True):
+        """
+        Remove events of a topic which the latest snapshot covers and which are beyond a max. length or age, or
+        which are superseded by a later event of the same entity (or are deletions), i.e. replaying the remaining
+        events still yields all entities.
+
+        Events not yet applied to the domain model cache or not yet delivered to (or acknowledged by) a consumer
+        group are kept. Only one process at a time compacts a topic.
+
+        :param _topic: The entity type.
+        :param _maxlen: The number of events to keep per stream, None to not trim by length.
+        :param _max_age: The number of seconds to keep events, None to not trim by age.
+        :param _compact: Remove events superseded by a later event of the same entity.
+        :return: A dict with the number of removed events and reclaimed bytes, None if another process compacts.
+        """
+        lock = self.redis.lock('{}_compact_lock'.format(_topic), timeout=600, blocking=False)
+        if not lock.acquire():
+            return None
+
+        try:
+            limits = self._retention_limits(_topic)
+
+            # find the latest covered event of every entity in replay order
+            latest = {}
+            if _compact:
+                for key, action in replay_streams(self.layout, _topic):
+                    for entry_id, fields in self._read_covered(key, limits.get(key)):
+                        latest[decode_entity(fields)['id']] = (key, entry_id, action or fields['action'])
+
+            cutoff = time.time() - _max_age if _max_age else None
+            stats = {'entries': 0, 'bytes': 0}
+            for key, _ in replay_streams(self.layout, _topic):
+                length = self.redis.xlen(key)
+                removed = []
+                kept = None
+                for index, (entry_id, fields) in enumerate(self._read_covered(key, limits.get(key))):
+                    entity_id = decode_entity(fields)['id']
+                    if (_maxlen is not None and index < length - _maxlen) or \
+                            (cutoff and entry_ts(entry_id, fields) < cutoff) or \
+                            (_compact and latest[entity_id][:2] != (key, entry_id)) or \
+                            (_compact and latest[entity_id][2] == 'deleted'):
+                        removed.append(entry_id)
+                    elif not kept:
+                        kept = entry_id
+                if not removed:
+                    continue
+
+                size = self.redis.memory_usage(key) or 0
+
+                # trim the removed prefix, delete the rest
+                minid = kept or '{}-{}'.format(*next_id(removed[-1]))
+                trimmed = self.redis.xtrim(key, minid=minid, approximate=False)
+                pipe = self.redis.pipeline(transaction=False)
+                rest = [i for i in removed if id_order(i) >= id_order(minid)]
+                for i in range(0, len(rest), self.chunk_size):
+                    pipe.xdel(key, *rest[i:i + self.chunk_size])
+                deleted = sum(pipe.execute())
+
+                stats['entries'] += trimmed + deleted
+                stats['bytes'] += max(size - (self.redis.memory_usage(key) or 0), 0)
+        finally:
+            lock.release()
+
+        totals = self.retention_stats.setdefault(_topic, {'entries': 0, 'bytes': 0})
+        totals['entries'] += stats['entries']
+        totals['bytes'] += stats['bytes']
+        log_info('compacted {} events of {}, reclaimed {} bytes'.format(stats['entries'], _topic, stats['bytes']))
+
+        return stats
+
+    def _retention_limits(self, _topic):
+        """
+        Get the stream entry ids up to which events of a topic may be removed, i.e. the entries covered by the
+        latest snapshot, applied to the domain model cache and delivered to and acknowledged by all consumer groups.
+
+        :param _topic: The entity type.
+        :return: A dict mapping stream key -> stream entry id tuple, entries with lower ids may be removed.
+        """
+        _, snapshot = self.snapshots.load(_topic)
+        checkpoint = self.domain_model.checkpoint(_topic)
+        limits = {}
+        for key, _ in replay_streams(self.layout, _topic):
+            if key not in snapshot or (checkpoint and key not in checkpoint):
+                continue
+            limit = next_id(snapshot[key])
+            if checkpoint:
+                limit = min(limit, next_id(checkpoint[key]))
+            for group in self.redis.xinfo_groups(key):
+                limit = min(limit, next_id(group['last-delivered-id']))
+                if group['pending']:
+                    limit = min(limit, id_order(self.redis.xpending(key, group['name'])['min']))
+            limits[key] = limit
+        return limits
+
+    def _read_covered(self, _key, _limit):
+        """
+        Read the entries of an event stream with ids below a limit.
+
+        :param _key: The stream key.
+        :param _limit: A stream entry id tuple, None to read nothing.
+        :return: A generator of tuples of stream entry id and entry fields.
+        """
+        if not _limit:
+            return
+        for entry_id, fields in self._read(_key):
+            if id_order(entry_id) >= _limit:
+                return
+            yield entry_id, fields
+
+    def enable_cache(self, _topic, _size=10000, _ttl=60):
+        """
+        Serve find_one and find_many for a topic from an in-process cache, kept coherent by entity events.
+
+        The entity events are written into the in-process cache only, as the domain model cache on Redis is kept up
+        to date by the service owning the topic and may lag behind.
+
+        :param _topic: The entity type.
+        :param _size: The max. number of cached entities.
+        :param _ttl: The max. number of seconds an entity is cached, None for no expiry.
+        """
+        if _topic not in self.caches:
+            self.caches[_topic] = EntityCache(_size, _ttl)
+        if _topic not in self.cache_handlers:
+            handlers = dict((a, functools.partial(self.cached_entities_changed, _topic, a)) for a in ACTIONS)
+            for action, handler in handlers.items():
+                handler.batch = True
+                self.subscribe(_topic, action, handler)
+            self.cache_handlers[_topic] = handlers
+
+    def disable_cache(self, _topic):
+        """
+        Stop serving find_one and find_many for a topic from an in-process cache.
+
+        :param _topic: The entity type.
+        """
+        handlers = self.cache_handlers.pop(_topic, {})
+        for action, handler in handlers.items():
+            self.unsubscribe(_topic, action, handler)
+        self.caches.pop(_topic, None)
+
     def subscribe_to_entity_events(self, _topic):
         """
-        Keep entity cache up to date.
+        Keep entity cache up to date, i.e. catch up with the events missed since the last checkpoint and
+        continue from there.
 
         :param _topic: The entity type.
         """
-        self.subscribe(_topic, 'created', functools.partial(self.entity_created, _topic))
-        self.subscribe(_topic, 'deleted', functools.partial(self.entity_deleted, _topic))
-        self.subscribe(_topic, 'updated', functools.partial(self.entity_updated, _topic))
+        last_ids = {}
+        if self.domain_model.checkpoint(_topic):
+            checkpoint = self.catch_up(_topic)
+            last_ids = dict((action, checkpoint.get(self.key(_topic, action), '0-0')) for action in ACTIONS)
+
+        handlers = {
+            'created': functools.partial(self.entity_created, _topic),
+            'deleted': functools.partial(self.entity_deleted, _topic),
+            'updated': functools.partial(self.entity_updated, _topic)
+        }
+        for action, handler in handlers.items():
+            handler.batch = True
+            self.subscribe(_topic, action, handler, last_ids.get(action, '$'))
+        self.entity_handlers[_topic] = handlers
 
     def unsubscribe_from_entity_events(self, _topic):
         """
@@ -156,127 +732,336 @@ class EventStore(object):
 
         :param _topic: The entity type.
         """
-        self.unsubscribe(_topic, 'created', functools.partial(self.entity_created, _topic))
-        self.unsubscribe(_topic, 'deleted', functools.partial(self.entity_deleted, _topic))
-        self.unsubscribe(_topic, 'updated', functools.partial(self.entity_updated, _topic))
+        handlers = self.entity_handlers.pop(_topic, {})
+        for action, handler in handlers.items():
+            self.unsubscribe(_topic, action, handler)
+        self.snapshot_policies.pop(_topic, None)
+        self.retention_policies.pop(_topic, None)
 
     def entity_created(self, _topic, _item):
         """
-        Event handler for entity created events, i.e. create a cached entity.
+        Event handler for entity created events, i.e. create cached entities.
 
         :param _topic: The entity type.
-        :param _item: A dict with entity properties.
+        :param _item: A list of the stream key and a list of stream entries.
         """
+        entities = [decode_entity(entry[1]) for entry in _item[1]]
         if self.domain_model.exists(_topic):
-            entity = json.loads(_item[1][0][1]['entity'])
-            self.domain_model.create(_topic, entity)
+            self.domain_model.apply(_topic, entities, (), {_item[0]: _item[1][-1][0]})
+        self.entities_changed(_topic, entities)
 
     def entity_deleted(self, _topic, _item):
         """
-        Event handler for entity deleted events, i.e. delete a cached entity.
+        Event handler for entity deleted events, i.e. delete cached entities.
 
         :param _topic: The entity type.
-        :param _item: A dict with entity properties.
+        :param _item: A list of the stream key and a list of stream entries.
         """
+        entities = [decode_entity(entry[1]) for entry in _item[1]]
         if self.domain_model.exists(_topic):
-            entity = json.loads(_item[1][0][1]['entity'])
-            self.domain_model.delete(_topic, entity)
+            self.domain_model.apply(_topic, (), entities, {_item[0]: _item[1][-1][0]})
+        self.entities_changed(_topic, entities)
 
     def entity_updated(self, _topic, _item):
         """
-        Event handler for entity updated events, i.e. update a cached entity.
+        Event handler for entity updated events, i.e. update cached entities.
 
         :param _topic: The entity type.
-        :param _item: A dict with entity properties.
+        :param _item: A list of the stream key and a list of stream entries.
         """
+        entities = [decode_entity(entry[1]) for entry in _item[1]]
         if self.domain_model.exists(_topic):
-            entity = json.loads(_item[1][0][1]['entity'])
-            self.domain_model.update(_topic, entity)
+            self.domain_model.apply(_topic, entities, (), {_item[0]: _item[1][-1][0]})
+        self.entities_changed(_topic, entities)
 
-    @staticmethod
-    def remove_deleted(created, deleted):
+    def cached_entities_changed(self, _topic, _action, _item):
         """
-        Remove deleted events.
+        Event handler for entity events of a topic cached in-process, i.e. write the changed entities through.
 
-        :param created: A dict mapping id -> dict of created events.
-        :param deleted: A list of deleted ids.
-        :return: A dict without deleted events.
+        :param _topic: The entity type.
+        :param _action: The event action.
+        :param _item: A list of the stream key and a list of stream entries.
         """
-        for d in deleted:
-            del created[d]
-        return created
+        cache = self.caches.get(_topic)
+        if not cache:
+            return
 
-    @staticmethod
-    def set_updated(created, updated):
+        entities = [decode_entity(entry[1]) for entry in _item[1]]
+        if _action == 'deleted':
+            cache.set_many({}, [entity['id'] for entity in entities])
+        else:
+            cache.set_many(dict((entity['id'], entity) for entity in entities))
+
+    def entities_changed(self, _topic, _entities):
+        """
+        Invalidate changed entities in the in-process cache and count them for the snapshot policy.
+
+        :param _topic: The entity type.
+        :param _entities: A list of dicts with entity properties.
         """
-        Adapt updated events.
+        for entity in _entities:
+            self.invalidate(_topic, entity)
+        self._snapshot_if_due(_topic, len(_entities))
 
-        :param created: A dict mapping id -> dict of created events.
-        :param updated: A dict mapping id -> dict of updated events.
-        :return: A dict with updated events.
+    def invalidate(self, _topic, _entity):
         """
-        for k, v in updated.items():
-            created[k] = v
-        return created
+        Drop an entity from the in-process cache, if enabled for the topic.
+
+        :param _topic: The entity type.
+        :param _entity: A dict with entity properties.
+        """
+        cache = self.caches.get(_topic)
+        if cache:
+            cache.invalidate(_entity['id'])
+
+
+def id_order(_entry_id):
+    """
+    Get the sort key of a stream entry id, i.e. a tuple of milliseconds and sequence number.
+
+    :param _entry_id: The stream entry id.
+    :return: A tuple of ints.
+    """
+    return tuple(map(int, _entry_id.split('-')))
+
+
+def next_id(_entry_id):
+    """
+    Get the sort key of the smallest stream entry id after a stream entry id.
+
+    :param _entry_id: The stream entry id.
+    :return: A tuple of ints.
+    """
+    ms, seq = id_order(_entry_id)
+    return ms, seq + 1
+
+
+def entry_ts(_entry_id, _fields):
+    """
+    Get the timestamp of a stream entry, i.e. of its ts field or of its id for entries published without one.
+
+    :param _entry_id: The stream entry id.
+    :param _fields: The stream entry fields.
+    :return: The timestamp in seconds.
+    """
+    if 'ts' in _fields:
+        return float(_fields['ts'])
+    seconds, microseconds = id_order(_entry_id)
+    return seconds + microseconds / 1000000.0
+
+
+def entry_order(_item):
+    """
+    Get the sort key of a stream entry, i.e. its id as a tuple of milliseconds and sequence number.
+
+    :param _item: A tuple of stream key and stream entry.
+    :return: A tuple of ints.
+    """
+    return id_order(_item[1][0])
 
 
 class Subscriber(threading.Thread):
     """
-    Subscriber Thread class.
+    Subscriber Thread class, i.e. one thread reading all subscribed event streams at once and routing their
+    entries to the handlers.
     """
+    count = 1000
+    reclaim_interval = 30
+    min_idle_time = 60000
 
-    def __init__(self, _topic, _action, _handler, _redis):
+    def __init__(self, _redis, _group=None, _workers=1):
         """
-        :param _topic: The topic to subscirbe to.
-        :param _action: The action to scubscribe to.
-        :param _handler: A handler function.
         :param _redis: A Redis instance.
+        :param _group: An optional consumer group name.
+        :param _workers: The number of threads calling the handlers.
         """
         super(Subscriber, self).__init__()
         self._running = False
-        self.key = 'events:{}_{}'.format(_topic, _action)
         self.subscribed = True
-        self.handlers = [_handler]
         self.redis = _redis
+        self.group = _group
+        self.consumer = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.reclaimed = 0
+        self.executor = ThreadPoolExecutor(_workers) if _workers > 1 else None
+        self.streams = {}
+        self.handlers = {}
+        self.lock = threading.Lock()
 
     def __len__(self):
-        return bool(self.handlers)
+        return len(self.handlers)
 
     def run(self):
         """
-        Poll the event stream and call each handler for each entry returned.
+        Poll the event streams in batches of up to count entries per stream and call the handlers for the entries
+        returned. Errors reading or acknowledging entries are logged and retried after a second, as one thread
+        serves all subscriptions.
         """
         if self._running:
             return
 
-        last_id = '$'
         self._running = True
         while self.subscribed:
-            items = self.redis.xread({self.key: last_id}, block=1000) or []
-            for item in items:
-                for handler in self.handlers:
-                    handler(item)
-                last_id = item[1][0][0]
+            with self.lock:
+                streams = dict(self.streams)
+            if not streams:
+                time.sleep(0.1)
+                continue
+            try:
+                entries = self.read(streams)
+                if not entries:
+                    continue
+                handled = self.handle(entries)
+                if self.group:
+                    for key in set(k for k, _ in handled):
+                        self.redis.xack(key, self.group, *[i for k, i in handled if k == key])
+            except Exception as e:
+                log_error(e)
+                time.sleep(1)
         self._running = False
 
+    def create_group(self, _key):
+        """
+        Create the consumer group for a stream, starting with new entries, unless it exists already.
+
+        :param _key: The stream key.
+        """
+        try:
+            self.redis.xgroup_create(_key, self.group, id='$', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, _streams):
+        """
+        Read the next entries of all streams, i.e. for a consumer group also reclaim entries other consumers did
+        not acknowledge.
+
+        :param _streams: A dict mapping stream key -> stream entry id to read after.
+        :return: A list of tuples of stream key and stream entry, ordered by stream entry id.
+        """
+        if not self.group:
+            items = self.redis.xread(_streams, count=self.count, block=1000) or []
+            with self.lock:
+                for key, entries in items:
+                    if key in self.streams:
+                        self.streams[key] = entries[-1][0]
+            return sorted([(key, entry) for key, entries in items for entry in entries], key=entry_order)
+
+        try:
+            if time.time() - self.reclaimed >= self.reclaim_interval:
+                self.reclaimed = time.time()
+                claimed = []
+                for key in _streams:
+                    entries = self.redis.xautoclaim(key, self.group, self.consumer, self.min_idle_time)[1]
+                    claimed.extend((key, entry) for entry in entries if entry[1])
+                if claimed:
+                    return sorted(claimed, key=entry_order)
+
+            items = self.redis.xreadgroup(self.group, self.consumer, _streams, count=self.count, block=1000) or []
+        except ResponseError as e:
+            if 'NOGROUP' not in str(e):
+                raise
+
+            # the stream or group was deleted, e.g. by FLUSHDB
+            log_info('recreating consumer group {}: {}'.format(self.group, e))
+            for key in _streams:
+                self.create_group(key)
+            return []
+
+        return sorted([(key, entry) for key, entries in items for entry in entries], key=entry_order)
+
+    def handle(self, _entries):
+        """
+        Call the handlers for entries in order, i.e. for each run of consecutive entries with the same stream and
+        action, handlers with a true batch attribute once with all entries of the run and all other handlers once
+        per entry.
+
+        :param _entries: A list of tuples of stream key and stream entry.
+        :return: A list of tuples of stream key and id of the entries all handlers succeeded for.
+        """
+        handled = []
+        runs = itertools.groupby(_entries, key=lambda x: (x[0], x[1][1].get('action')))
+        for (key, action), run in runs:
+            entries = [entry for _, entry in run]
+            with self.lock:
+                handlers = self.handlers.get((key, None), []) + (self.handlers.get((key, action), []) if action else [])
+            ok = dict((entry[0], True) for entry in entries)
+
+            for handler in filter(lambda x: getattr(x, 'batch', False), handlers):
+                if not self.call(handler, [key, entries]):
+                    ok = dict.fromkeys(ok, False)
+
+            entry_handlers = [h for h in handlers if not getattr(h, 'batch', False)]
+            if entry_handlers:
+                def call_all(_entry):
+                    return all(self.call(h, [key, [_entry]]) for h in entry_handlers)
+
+                results = self.executor.map(call_all, entries) if self.executor else map(call_all, entries)
+                for entry, result in zip(entries, list(results)):
+                    ok[entry[0]] = ok[entry[0]] and result
+
+            handled.extend((key, entry_id) for entry_id, result in ok.items() if result)
+
+        return handled
+
+    @staticmethod
+    def call(_handler, _item):
+        """
+        Call a handler and log its errors.
+
+        :param _handler: The handler function.
+        :param _item: A list of the stream key and a list of stream entries.
+        :return: True iff the handler succeeded.
+        """
+        try:
+            _handler(_item)
+        except Exception as e:
+            log_error(e)
+            return False
+
+        return True
+
     def stop(self):
         """
-        Stop polling the event stream.
+        Stop polling the event streams.
         """
         self.subscribed = False
+        if self.executor:
+            self.executor.shutdown(wait=False)
 
-    def add_handler(self, _handler):
+    def add_handler(self, _key, _action, _handler, _last_id='$'):
         """
         Add an event handler.
 
+        :param _key: The stream key.
+        :param _action: The action to filter entries by, None if the stream only has entries of one action.
         :param _handler: The event handler function.
+        :param _last_id: The stream entry id to start after, if the stream is not subscribed to yet.
         """
-        self.handlers.append(_handler)
+        with self.lock:
+            if _key not in self.streams:
+                if self.group:
+                    self.create_group(_key)
+                    self.streams[_key] = '>'
+                elif _last_id == '$':
+                    last = self.redis.xrevrange(_key, count=1)
+                    self.streams[_key] = last[0][0] if last else '0-0'
+                else:
+                    self.streams[_key] = _last_id
+            self.handlers.setdefault((_key, _action), []).append(_handler)
 
-    def rem_handler(self, _handler):
+    def rem_handler(self, _key, _action, _handler):
         """
         Remove an event handler.
 
+        :param _key: The stream key.
+        :param _action: The action the handler was added for.
         :param _handler: The event handler function.
         """
-        self.handlers.remove(_handler)
+        with self.lock:
+            handlers = self.handlers.get((_key, _action), [])
+            handlers.remove(_handler)
+            if not handlers:
+                del self.handlers[(_key, _action)]
+            if not any(key == _key for key, _ in self.handlers):
+                del self.streams[_key]
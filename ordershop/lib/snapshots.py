@@ -0,0 +1,85 @@
+import json
+import time
+import zlib
+
+
+class Snapshots(object):
+    """
+    Snapshots class, i.e. compressed snapshots of all aggregated entities of a topic on Redis.
+    """
+
+    def __init__(self, _redis):
+        """
+        :param _redis: A redis instance, must not decode responses.
+        """
+        self.redis = _redis
+
+    def save(self, _topic, _entities, _checkpoint):
+        """
+        Save a snapshot, replacing the previous one.
+
+        :param _topic: The entity type.
+        :param _entities: A dict mapping id -> entity.
+        :param _checkpoint: A dict mapping stream key -> id of the last stream entry the snapshot covers.
+        :return: The size of the snapshot in bytes.
+        """
+        data = Snapshots.encode(_entities, _checkpoint)
+        self.redis.set(Snapshots.key(_topic), data)
+        return len(data)
+
+    def load(self, _topic):
+        """
+        Load the latest snapshot.
+
+        :param _topic: The entity type.
+        :return: A tuple of a dict mapping id -> entity and a dict mapping stream key -> stream entry id, both
+                 empty if there is no snapshot.
+        """
+        return Snapshots.decode(self.redis.get(Snapshots.key(_topic)))
+
+    def delete(self, _topic):
+        """
+        Delete the latest snapshot.
+
+        :param _topic: The entity type.
+        """
+        self.redis.delete(Snapshots.key(_topic))
+
+    @staticmethod
+    def key(_topic):
+        """
+        Get the key of the snapshot of a topic.
+
+        :param _topic: The entity type.
+        :return: The snapshot key.
+        """
+        return '{}_snapshot'.format(_topic)
+
+    @staticmethod
+    def encode(_entities, _checkpoint):
+        """
+        Encode a snapshot.
+
+        :param _entities: A dict mapping id -> entity.
+        :param _checkpoint: A dict mapping stream key -> id of the last stream entry the snapshot covers.
+        :return: The compressed snapshot.
+        """
+        return zlib.compress(json.dumps({
+            'ts': time.time(),
+            'checkpoint': _checkpoint,
+            'entities': list(_entities.values())
+        }).encode('utf-8'))
+
+    @staticmethod
+    def decode(_data):
+        """
+        Decode a snapshot.
+
+        :param _data: The compressed snapshot, None if there is no snapshot.
+        :return: A tuple of a dict mapping id -> entity and a dict mapping stream key -> stream entry id, both
+                 empty if there is no snapshot.
+        """
+        if not _data:
+            return {}, {}
+        snapshot = json.loads(zlib.decompress(_data).decode('utf-8'))
+        return dict((e['id'], e) for e in snapshot['entities']), snapshot['checkpoint']
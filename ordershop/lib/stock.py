@@ -0,0 +1,139 @@
+from lib.event_store import Event, event_entries
+
+
+# the counter value of a deleted inventory, as its cached entity is only removed later
+DELETED = 'deleted'
+
+# check all counters and entry ids first, then change them and publish one updated event per inventory
+RESERVE = """
+local n = tonumber(ARGV[1])
+local amounts = {}
+for i = 1, n do
+    local amount = redis.call('GET', KEYS[2 * i - 1])
+    if amount == ARGV[4 * n + 4] then
+        return redis.error_reply('deleted inventory ' .. KEYS[2 * i - 1])
+    end
+    amount = amount or redis.call('HGET', KEYS[2 * i], ARGV[3])
+    if not amount then
+        return redis.error_reply('no stock counter ' .. KEYS[2 * i - 1])
+    end
+    amounts[i] = tonumber(amount) - tonumber(ARGV[4 * i])
+    if amounts[i] < 0 then
+        return 0
+    end
+end
+
+-- fail before writing anything if the (increasing) entry ids are not after the last one of the stream
+if ARGV[7] ~= '*' and redis.call('EXISTS', KEYS[2 * n + 1]) == 1 then
+    local info = redis.call('XINFO', 'STREAM', KEYS[2 * n + 1])
+    for j = 1, #info, 2 do
+        if info[j] == 'last-generated-id' then
+            local ms, seq = string.match(info[j + 1], '(%d+)-(%d+)')
+            local new_ms, new_seq = string.match(ARGV[7], '(%d+)-(%d+)')
+            ms, seq, new_ms, new_seq = tonumber(ms), tonumber(seq), tonumber(new_ms), tonumber(new_seq)
+            if new_ms < ms or (new_ms == ms and new_seq <= seq) then
+                return redis.error_reply('ERR The ID specified in XADD is equal or smaller than ' ..
+                                         'the target stream top item')
+            end
+        end
+    end
+end
+
+for i = 1, n do
+    redis.call('SET', KEYS[2 * i - 1], amounts[i])
+    local entity = {}
+    local values = redis.call('HGETALL', KEYS[2 * i])
+    for j = 1, #values, 2 do
+        if string.sub(values[j], 1, 6) ~= '_type:' then
+            entity[values[j]] = values[j + 1]
+        end
+    end
+    entity[ARGV[3]] = amounts[i]
+    local fields = {'event_id', ARGV[4 * i + 1], 'ts', ARGV[4 * i + 2], 'entity', cjson.encode(entity)}
+    if ARGV[2] ~= '' then
+        table.insert(fields, 'action')
+        table.insert(fields, ARGV[2])
+    end
+    redis.call('XADD', KEYS[2 * n + 1], ARGV[4 * i + 3], unpack(fields))
+end
+return 1
+"""
+
+
+class Stock(object):
+    """
+    Stock class, i.e. a counter per inventory on Redis, checked and changed atomically with publishing the
+    inventory events, so concurrent orders can not oversell.
+    """
+    deleted_ttl = 86400
+
+    def __init__(self, _store, _topic='inventory', _field='amount'):
+        """
+        :param _store: The event store.
+        :param _topic: The entity type of the inventory.
+        :param _field: The field of the inventory holding the amount.
+        """
+        self.store = _store
+        self.topic = _topic
+        self.field = _field
+        self.script = _store.redis.register_script(RESERVE)
+
+    def key(self, _id):
+        """
+        Get the key of the counter of an inventory.
+
+        :param _id: The inventory id.
+        :return: The counter key.
+        """
+        return '{}_stock:{}'.format(self.topic, _id)
+
+    def publish(self, _events):
+        """
+        Publish inventory events, setting the counters in the same transaction. The counter of a deleted inventory is
+        kept as DELETED for deleted_ttl seconds, so it is not initialized from the cached inventory again.
+
+        :param _events: The inventory events.
+        :return: A list of the stream entry ids.
+        """
+        pipe = self.store.redis.pipeline()
+        for event in _events:
+            if event.action == 'deleted':
+                pipe.set(self.key(event.entity['id']), DELETED, ex=self.deleted_ttl)
+            else:
+                pipe.set(self.key(event.entity['id']), event.entity[self.field])
+        for key, entry_id, fields in event_entries(self.store.layout, _events, self.store.ids, self.store.codec):
+            pipe.xadd(key, fields, id=entry_id)
+
+        return pipe.execute()[-len(_events):] if _events else []
+
+    def reserve(self, _amounts):
+        """
+        Take amounts of products from their inventory, i.e. all of them or none if any inventory is too low, and
+        publish an updated event per inventory. The event entities are always JSON encoded.
+
+        A counter is initialized from the cached inventory when it is first used.
+
+        :param _amounts: A dict mapping product id -> amount, negative amounts are added to the inventory.
+        :return: True iff the amounts were taken.
+        """
+        inventories = []
+        for product_id, amount in _amounts.items():
+            inventory = list(self.store.find_by(self.topic, 'product_id', product_id).values())
+            if not inventory:
+                raise ValueError("could not find inventory")
+            inventories.append((inventory[0], amount))
+
+        if not inventories:
+            return True
+
+        events = [Event(self.topic, 'updated', **inventory) for inventory, _ in inventories]
+        keys = []
+        args = [len(events), 'updated' if self.store.layout == self.store.SINGLE else '', self.field]
+        for (inventory, amount), (_, entry_id, fields) in \
+                zip(inventories, event_entries(self.store.layout, events, self.store.ids)):
+            keys += [self.key(inventory['id']), '{}_entity:{}'.format(self.topic, inventory['id'])]
+            args += [amount, fields['event_id'], fields['ts'], entry_id]
+        keys.append(self.store.key(self.topic, 'updated'))
+        args.append(DELETED)
+
+        return bool(self.script(keys=keys, args=args))
@@ -1,13 +1,14 @@
 import atexit
 import json
 import os
-import requests
+from collections import Counter
 
 from flask import request
 from flask import Flask
 
+from common import http_client
 from common.factory import create_order
-from common.utils import check_rsp_code
+from common.utils import check_rsp_code, list_entities
 from lib.event_store import Event, EventStore
 
 
@@ -18,6 +19,25 @@ store = EventStore()
 if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     store.subscribe_to_entity_events('order')
     atexit.register(store.unsubscribe_from_entity_events, 'order')
+    store.enable_snapshots('order')
+    store.enable_retention('order')
+
+
+def adjust_inventory(_old_product_ids, _new_product_ids):
+    """
+    Helper function to adjust the inventory from the products of an old order to those of a new one, all at once.
+
+    :param _old_product_ids: The product ids of the old order, which are put back.
+    :param _new_product_ids: The product ids of the new order, which are taken.
+    :return: True iff all products of the new order were in stock.
+    """
+    amounts = Counter(_new_product_ids)
+    amounts.subtract(_old_product_ids)
+
+    rsp = http_client.post('http://inventory-service:5000/adjust', json=dict(amounts))
+    check_rsp_code(rsp)
+
+    return rsp.json()
 
 
 @app.route('/orders', methods=['GET'])
@@ -31,20 +51,13 @@ def get(order_id=None):
 
         return json.dumps(order) if order else json.dumps(False)
     else:
-        return json.dumps([item for item in store.find_all('order').values()])
+        return list_entities(store, 'order', request.args)
 
 
 @app.route('/orders/unbilled', methods=['GET'])
 def get_unbilled():
 
-    billings = store.find_all('billing').values()
-    orders = list(store.find_all('order').values())
-
-    for billing in billings:
-        to_remove = list(filter(lambda x: x['id'] == billing['order_id'], orders))
-        orders.remove(to_remove[0])
-
-    return json.dumps([item for item in orders])
+    return list_entities(store, 'order', request.args, ('billing', 'order_id'))
 
 
 @app.route('/order', methods=['POST'])
@@ -55,34 +68,31 @@ def post():
     if not isinstance(values, list):
         values = [values]
 
-    rsp = requests.post('http://inventory-service:5000/decr_from_order', json=values)
+    rsp = http_client.post('http://inventory-service:5000/decr_from_order', json=values)
     check_rsp_code(rsp)
 
     if not rsp.json():
         raise ValueError("out of stock")
 
-    order_ids = []
+    new_orders = []
     for value in values:
         try:
-            new_order = create_order(value['product_ids'], value['customer_id'])
+            new_orders.append(create_order(value['product_ids'], value['customer_id']))
         except KeyError:
             raise ValueError("missing mandatory parameter 'product_ids' and/or 'customer_id'")
 
-        # trigger event
-        store.publish(Event('order', 'created', **new_order))
-
-        order_ids.append(new_order['id'])
+    # trigger events
+    store.publish_many([Event('order', 'created', **new_order) for new_order in new_orders], _atomic=True)
 
-    return json.dumps(order_ids)
+    return json.dumps([new_order['id'] for new_order in new_orders])
 
 
 @app.route('/order/<order_id>', methods=['PUT'])
 def put(order_id):
 
-    order = store.find_one('order', order_id)
-    for product_id in order['product_ids']:
-        rsp = requests.post('http://inventory-service:5000/incr/{}'.format(product_id))
-        check_rsp_code(rsp)
+    current = store.find_one('order', order_id)
+    if not current:
+        raise ValueError("could not find order")
 
     value = request.get_json()
     try:
@@ -90,10 +100,7 @@ def put(order_id):
     except KeyError:
         raise ValueError("missing mandatory parameter 'product_ids' and/or 'customer_id'")
 
-    rsp = requests.post('http://inventory-service:5000/decr_from_order', json=value)
-    check_rsp_code(rsp)
-
-    if not rsp.json():
+    if not adjust_inventory(current['product_ids'], order['product_ids']):
         raise ValueError("out of stock")
 
     order['id'] = order_id
@@ -101,10 +108,6 @@ def put(order_id):
     # trigger event
     store.publish(Event('order', 'updated', **order))
 
-    for product_id in value['product_ids']:
-        rsp = requests.post('http://inventory-service:5000/decr/{}'.format(product_id))
-        check_rsp_code(rsp)
-
     return json.dumps(True)
 
 
@@ -113,9 +116,7 @@ def delete(order_id):
 
     order = store.find_one('order', order_id)
     if order:
-        for product_id in order['product_ids']:
-            rsp = requests.post('http://inventory-service:5000/incr/{}'.format(product_id))
-            check_rsp_code(rsp)
+        adjust_inventory(order['product_ids'], ())
 
         # trigger event
         store.publish(Event('order', 'deleted', **order))
@@ -6,6 +6,7 @@ from flask import request
 from flask import Flask
 
 from common.factory import create_product
+from common.utils import list_entities
 from lib.event_store import Event, EventStore
 
 
@@ -16,6 +17,8 @@ store = EventStore()
 if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     store.subscribe_to_entity_events('product')
     atexit.register(store.unsubscribe_from_entity_events, 'product')
+    store.enable_snapshots('product')
+    store.enable_retention('product')
 
 
 @app.route('/products', methods=['GET'])
@@ -29,7 +32,7 @@ def get(product_id=None):
 
         return json.dumps(product) if product else json.dumps(False)
     else:
-        return json.dumps([item for item in store.find_all('product').values()])
+        return list_entities(store, 'product', request.args)
 
 
 @app.route('/product', methods=['POST'])
@@ -40,19 +43,17 @@ def post():
     if not isinstance(values, list):
         values = [values]
 
-    product_ids = []
+    new_products = []
     for value in values:
         try:
-            new_product = create_product(value['name'], value['price'])
+            new_products.append(create_product(value['name'], value['price']))
         except KeyError:
             raise ValueError("missing mandatory parameter 'name' and/or 'price'")
 
-        # trigger event
-        store.publish(Event('product', 'created', **new_product))
-
-        product_ids.append(new_product['id'])
+    # trigger events
+    store.publish_many([Event('product', 'created', **new_product) for new_product in new_products], _atomic=True)
 
-    return json.dumps(product_ids)
+    return json.dumps([new_product['id'] for new_product in new_products])
 
 
 @app.route('/product/<product_id>', methods=['PUT'])